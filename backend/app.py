@@ -1,19 +1,71 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
+import hashlib
 import sqlite3
-import bcrypt
+import queue
 import jwt
+import orjson
 import datetime
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import passwords
+import services
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret-key'
 CORS(app)
 
+DATABASE = 'starbucks_budget.db'
+
+# Warm connections handed back at teardown instead of being closed
+_DB_POOL = queue.Queue(maxsize=8)
+
+# Bounded pool so concurrent hashing cannot starve the other endpoints
+_HASH_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
 # Database
+def _connect():
+    # Pooled connections outlive requests, so their prepared-statement cache does too
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -20000")
+    conn.execute("PRAGMA mmap_size = 268435456")
+    return conn
+
+def get_db():
+    """Return the request's connection, taken from the pool when one is free."""
+    if 'db' not in g:
+        try:
+            g.db = _DB_POOL.get_nowait()
+        except queue.Empty:
+            g.db = _connect()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        _DB_POOL.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
 def init_db():
-    conn = sqlite3.connect('starbucks_budget.db')
+    conn = sqlite3.connect(DATABASE)
     conn.execute("PRAGMA foreign_keys = ON")
+    # WAL persists in the database file, so readers no longer block on writers
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA wal_autocheckpoint = 1000")
+    conn.execute("PRAGMA mmap_size = 268435456")
+    conn.execute("PRAGMA cache_size = -64000")
+    conn.execute("PRAGMA temp_store = MEMORY")
     c = conn.cursor()
     
     # Users table
@@ -46,7 +98,22 @@ def init_db():
         price REAL NOT NULL,
         suitable_moods TEXT
     )''')
-    
+
+    # Beverage/mood pairs, normalized from beverages.suitable_moods so mood
+    # lookups are indexed equality matches (NOCASE keeps the old LIKE semantics)
+    c.execute('''CREATE TABLE IF NOT EXISTS beverage_moods (
+        beverage_id INTEGER NOT NULL,
+        mood TEXT NOT NULL COLLATE NOCASE,
+        PRIMARY KEY (beverage_id, mood),
+        FOREIGN KEY (beverage_id) REFERENCES beverages(id)
+    )''')
+
+    # Indices for the history/weekly-spending lookups and the beverage join
+    # (users.username is already covered by its UNIQUE constraint)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_purchases_user_date ON purchases(user_id, purchase_date DESC)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_purchases_beverage ON purchases(beverage_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_beverage_moods_mood ON beverage_moods(mood, beverage_id)')
+
     # Insert sample beverages
     beverages = [
         # $2-$4
@@ -81,10 +148,24 @@ def init_db():
     c.execute('SELECT COUNT(*) FROM beverages')
     if c.fetchone()[0] == 0:
         c.executemany('INSERT INTO beverages (name, category, price, suitable_moods) VALUES (?, ?, ?, ?)', beverages)
-    
+
+    c.execute('SELECT COUNT(*) FROM beverage_moods')
+    if c.fetchone()[0] == 0:
+        c.execute('SELECT id, suitable_moods FROM beverages')
+        mood_rows = [(beverage_id, mood.strip())
+                     for beverage_id, moods in c.fetchall() if moods
+                     for mood in moods.split(',') if mood.strip()]
+        c.executemany('INSERT OR IGNORE INTO beverage_moods (beverage_id, mood) VALUES (?, ?)', mood_rows)
+
     conn.commit()
+    # Refresh planner statistics so the new indices are picked up
+    c.execute('ANALYZE')
     conn.close()
 
+def ojson(obj, status=200):
+    """jsonify() replacement backed by orjson, for the list-heavy responses."""
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), status=status, mimetype='application/json')
+
 # JWT token
 def token_required(f):
     @wraps(f)
@@ -113,17 +194,15 @@ def register():
     if not all([username, email, password]):
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
     
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    password_hash = _HASH_EXECUTOR.submit(passwords.hash_password, password).result()
     
     try:
-        conn = sqlite3.connect('starbucks_budget.db')
-        conn.execute("PRAGMA foreign_keys = ON")
+        conn = get_db()
         c = conn.cursor()
         c.execute('INSERT INTO users (username, email, password_hash, weekly_budget) VALUES (?, ?, ?, ?)',
                   (username, email, password_hash, weekly_budget))
         user_id = c.lastrowid
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -142,18 +221,19 @@ def login():
     if not all([username, password]):
         return jsonify({'success': False, 'message': 'Missing credentials'}), 400
     
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT * FROM users WHERE username = ?', (username,))
     user = c.fetchone()
-    conn.close()
     
     if not user:
         return jsonify({'success': False, 'message': 'Invalid credentials'}), 401
     
-    if bcrypt.checkpw(password.encode('utf-8'), user['password_hash']):
+    if _HASH_EXECUTOR.submit(passwords.check_password, password, user['password_hash']).result():
+        # Upgrade raw-password hashes to the pre-digested form on first login
+        if passwords.is_legacy_hash(user['password_hash']):
+            new_hash = _HASH_EXECUTOR.submit(passwords.hash_password, password).result()
+            c.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, user['id']))
         token = jwt.encode({
             'user_id': user['id'],
             'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=7)
@@ -170,24 +250,23 @@ def login():
 
 @app.route('/api/user/profile/<int:user_id>', methods=['GET'])
 def get_user_profile(user_id):
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, username, email, weekly_budget, created_at FROM users WHERE id = ?', (user_id,))
     user = c.fetchone()
-    conn.close()
     
     if not user:
         return jsonify({'success': False, 'message': 'User not found'}), 404
     
-    return jsonify({
+    response = jsonify({
         'user_id': user['id'],
         'username': user['username'],
         'email': user['email'],
         'weekly_budget': user['weekly_budget'],
         'member_since': user['created_at']
-    }), 200
+    })
+    response.add_etag()
+    return response.make_conditional(request)
 
 @app.route('/api/user/budget/<int:user_id>', methods=['PUT'])
 def update_budget(user_id):
@@ -197,12 +276,10 @@ def update_budget(user_id):
     if not new_budget or new_budget <= 0:
         return jsonify({'success': False, 'message': 'Invalid budget amount'}), 400
     
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
+    conn = get_db()
     c = conn.cursor()
     c.execute('UPDATE users SET weekly_budget = ? WHERE id = ?', (new_budget, user_id))
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True, 'message': 'Budget updated successfully'}), 200
 
@@ -217,14 +294,12 @@ def record_purchase():
     if not all([user_id, beverage_id, mood, price]):
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
     
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
+    conn = get_db()
     c = conn.cursor()
     c.execute('INSERT INTO purchases (user_id, beverage_id, mood, price) VALUES (?, ?, ?, ?)',
               (user_id, beverage_id, mood, price))
     purchase_id = c.lastrowid
     conn.commit()
-    conn.close()
     
     return jsonify({
         'success': True,
@@ -237,144 +312,113 @@ def get_purchase_history(user_id):
     limit = request.args.get('limit', 50, type=int)
     days = request.args.get('days', 365, type=int)
     
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    query = '''
-        SELECT p.id, p.mood, p.price, p.purchase_date,
-               b.name as beverage_name, b.category
-        FROM purchases p
-        JOIN beverages b ON p.beverage_id = b.id
-        WHERE p.user_id = ? AND p.purchase_date >= date('now', '-' || ? || ' days')
-        ORDER BY p.purchase_date DESC
-        LIMIT ?
-    '''
+    history = services.purchase_history(get_db(), user_id, limit=limit, days=days)
     
-    c.execute(query, (user_id, days, limit))
-    purchases = c.fetchall()
-    conn.close()
-    
-    history = [{
-        'purchase_id': p['id'],
-        'beverage_name': p['beverage_name'],
-        'category': p['category'],
-        'mood': p['mood'],
-        'price': p['price'],
-        'date': p['purchase_date']
-    } for p in purchases]
-    
-    return jsonify({
+    return ojson({
         'user_id': user_id,
         'total_purchases': len(history),
         'history': history
-    }), 200
+    })
 
 @app.route('/api/purchase/weekly-spending/<int:user_id>', methods=['GET'])
 def get_weekly_spending(user_id):
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    spending = services.weekly_spending(get_db(), user_id)
     
-    c.execute('SELECT weekly_budget FROM users WHERE id = ?', (user_id,))
-    user = c.fetchone()
-    if not user:
-        conn.close()
+    if spending is None:
         return jsonify({'success': False, 'message': 'User not found'}), 404
     
-    query = '''
-        SELECT COALESCE(SUM(price), 0) as spent
-        FROM purchases
-        WHERE user_id = ? AND purchase_date >= date('now', 'weekday 0', '-7 days')
-    '''
-    c.execute(query, (user_id,))
-    result = c.fetchone()
-    conn.close()
-    
-    spent = result['spent']
-    weekly_budget = user['weekly_budget']
-    
-    return jsonify({
-        'user_id': user_id,
-        'weekly_budget': weekly_budget,
-        'spent_this_week': round(spent, 2),
-        'remaining': round(weekly_budget - spent, 2),
-        'week_start': datetime.date.today() - datetime.timedelta(days=datetime.date.today().weekday()),
-        'week_end': datetime.date.today() + datetime.timedelta(days=(6 - datetime.date.today().weekday()))
-    }), 200
+    return jsonify(spending), 200
 
-@app.route('/api/beverages', methods=['GET'])
-def get_beverages():
-    mood = request.args.get('mood')
-    max_price = request.args.get('max_price', type=float)
-    
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.row_factory = sqlite3.Row
+# Beverage catalog, loaded once: no route mutates the beverages table
+_BEVERAGES_LIST = None
+_BEVERAGES_BY_ID = {}
+_BEVERAGE_IDS_BY_MOOD = {}
+
+def load_beverage_catalog():
+    """Load beverages and their mood index into memory on first use."""
+    global _BEVERAGES_LIST
+    if _BEVERAGES_LIST is not None:
+        return _BEVERAGES_LIST
+
+    conn = get_db()
     c = conn.cursor()
-    
-    query = 'SELECT * FROM beverages WHERE 1=1'
-    params = []
-    
-    if mood:
-        query += ' AND suitable_moods LIKE ?'
-        params.append(f'%{mood}%')
-    
-    if max_price:
-        query += ' AND price <= ?'
-        params.append(max_price)
-    
-    c.execute(query, params)
-    beverages = c.fetchall()
-    conn.close()
-    
-    result = [{
+    c.execute('SELECT * FROM beverages ORDER BY id')
+    beverages = [{
         'id': b['id'],
         'name': b['name'],
         'category': b['category'],
         'price': b['price'],
         'suitable_moods': b['suitable_moods'].split(',') if b['suitable_moods'] else []
-    } for b in beverages]
+    } for b in c.fetchall()]
+
+    c.execute('SELECT mood, beverage_id FROM beverage_moods')
+    ids_by_mood = defaultdict(set)
+    for row in c.fetchall():
+        ids_by_mood[row['mood'].lower()].add(row['beverage_id'])
+
+    _BEVERAGES_BY_ID.update((b['id'], b) for b in beverages)
+    _BEVERAGE_IDS_BY_MOOD.update(ids_by_mood)
+    _BEVERAGES_LIST = beverages
+    return beverages
+
+def _filter_beverages(mood, max_price):
+    beverages = load_beverage_catalog()
+    
+    if mood:
+        mood_ids = _BEVERAGE_IDS_BY_MOOD.get(mood.lower(), ())
+        beverages = [b for b in beverages if b['id'] in mood_ids]
+    
+    if max_price:
+        beverages = [b for b in beverages if b['price'] <= max_price]
+    
+    return beverages
+
+@lru_cache(maxsize=64)
+def _beverages_body(mood, max_price):
+    """Serialized /api/beverages body and its ETag, per filter combination."""
+    body = orjson.dumps({'beverages': _filter_beverages(mood, max_price)})
+    return body, hashlib.sha1(body).hexdigest()
+
+@app.route('/api/beverages', methods=['GET'])
+def get_beverages():
+    mood = request.args.get('mood')
+    max_price = request.args.get('max_price', type=float)
     
-    return jsonify({'beverages': result}), 200
+    body, etag = _beverages_body(mood, max_price)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # 304 with an empty body when the client's If-None-Match matches
+    return response.make_conditional(request)
 
 @app.route('/api/beverages/<int:beverage_id>', methods=['GET'])
 def get_beverage(beverage_id):
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM beverages WHERE id = ?', (beverage_id,))
-    beverage = c.fetchone()
-    conn.close()
+    load_beverage_catalog()
+    beverage = _BEVERAGES_BY_ID.get(beverage_id)
     
     if not beverage:
         return jsonify({'success': False, 'message': 'Beverage not found'}), 404
     
-    return jsonify({
-        'id': beverage['id'],
-        'name': beverage['name'],
-        'category': beverage['category'],
-        'price': beverage['price'],
-        'suitable_moods': beverage['suitable_moods'].split(',')
-    }), 200
+    return jsonify(beverage), 200
 
-from recommendation_engine import recommend
+from recommendation_engine import recommend, load_catalog as load_engine_catalog
 
 @app.route('/api/recommendations/<int:user_id>', methods=['GET'])
 def get_recommendations(user_id):
     mood = request.args.get("mood")
     budget = request.args.get("budget")
 
-    results = recommend(user_id, mood, budget)
-    return jsonify(results)
+    # In-process: the engine reads history/spending on this request's connection
+    results = recommend(user_id, mood, budget, conn=get_db())
+    return ojson(results)
 
 
 if __name__ == '__main__':
     init_db()
-    app.run(debug=True, port=5001)
+    with app.app_context():
+        load_beverage_catalog()
+    # Warm the recommender's catalog too so the first request doesn't pay for it
+    load_engine_catalog()
+    app.run(debug=True, port=5001, threaded=True)
 
 
 
@@ -9,10 +9,16 @@ Creates diverse user profiles with realistic purchasing patterns to train:
 """
 
 import sqlite3
+import heapq
 import random
-import hashlib
+import sys
 from datetime import datetime, timedelta
 
+from passwords import hash_password
+
+# Shared password for every test account
+TEST_PASSWORD = 'test123'
+
 # Test User Profiles
 USER_PROFILES = [
     {
@@ -90,11 +96,6 @@ USER_PROFILES = [
 ]
 
 
-def hash_password(password):
-    """Simple password hashing"""
-    return hashlib.sha256(password.encode()).hexdigest()
-
-
 def get_beverages(conn):
     """Fetch all beverages from database"""
     cursor = conn.cursor()
@@ -111,9 +112,10 @@ def get_beverages(conn):
     return beverages
 
 
-def select_beverage_for_profile(beverages, profile, mood):
+def build_beverage_pool(beverages, profile, mood):
     """
-    Select beverage based on user profile pattern
+    Filter and rank beverages for a profile/mood once, so repeated
+    selections are plain lookups instead of list scans and sorts
     """
     pattern = profile['pattern']
 
@@ -128,31 +130,61 @@ def select_beverage_for_profile(beverages, profile, mood):
     if category_filtered:
         beverages = category_filtered
 
+    mid_price = sum(b['price'] for b in beverages) / len(beverages)
+    balanced = [b for b in beverages if abs(b['price'] - mid_price) < 2.0]
+    favorites = [b for b in beverages if b['category'] in ['Coffee', 'Espresso']]
+
+    return {
+        'candidates': beverages,
+        'cheapest': min(beverages, key=lambda x: x['price']),
+        'most_expensive': heapq.nlargest(3, beverages, key=lambda x: x['price']),
+        'balanced': balanced if balanced else beverages,
+        'favorite': min(favorites, key=lambda x: x['price']) if favorites else None,
+        'best_value': min(beverages, key=lambda x: (1 / x['price']) *
+                          (1 if x['category'] in profile['category_preference'] else 0.5)),
+    }
+
+
+def build_profile_pools(beverages, profile):
+    """Precompute beverage pools for each of a profile's moods"""
+    return {mood: build_beverage_pool(beverages, profile, mood)
+            for mood in profile['mood_preference']}
+
+
+def select_beverage_for_profile(beverages, profile, mood, pools=None):
+    """
+    Select beverage based on user profile pattern
+    """
+    pattern = profile['pattern']
+
+    if pools is not None and mood in pools:
+        pool = pools[mood]
+    else:
+        pool = build_beverage_pool(beverages, profile, mood)
+    beverages = pool['candidates']
+
     # Apply pattern-specific selection
     if pattern == 'frugal':
         # Always pick cheapest
-        return min(beverages, key=lambda x: x['price'])
+        return pool['cheapest']
 
     elif pattern == 'premium':
         # Prefer expensive (70% expensive, 30% random)
         if random.random() < 0.7:
-            expensive = sorted(beverages, key=lambda x: x['price'], reverse=True)
-            return expensive[random.randint(0, min(2, len(expensive) - 1))]
+            expensive = pool['most_expensive']
+            return expensive[random.randint(0, len(expensive) - 1)]
         return random.choice(beverages)
 
     elif pattern == 'balanced':
         # Mix of price ranges
-        mid_price = sum(b['price'] for b in beverages) / len(beverages)
-        balanced = [b for b in beverages if abs(b['price'] - mid_price) < 2.0]
-        return random.choice(balanced if balanced else beverages)
+        return random.choice(pool['balanced'])
 
     elif pattern == 'frequent':
         # High consistency - same drinks often
         if random.random() < profile['consistency']:
             # Return favorite (cheapest coffee/espresso)
-            favorites = [b for b in beverages if b['category'] in ['Coffee', 'Espresso']]
-            if favorites:
-                return min(favorites, key=lambda x: x['price'])
+            if pool['favorite'] is not None:
+                return pool['favorite']
         return random.choice(beverages)
 
     elif pattern == 'explorer':
@@ -162,9 +194,7 @@ def select_beverage_for_profile(beverages, profile, mood):
     elif pattern == 'strategic':
         # Maximize value (quality/price ratio)
         # Assume price correlates with quality, find sweet spot
-        value_drinks = sorted(beverages, key=lambda x: (1 / x['price']) *
-                            (1 if x['category'] in profile['category_preference'] else 0.5))
-        return value_drinks[0] if value_drinks else random.choice(beverages)
+        return pool['best_value']
 
     elif pattern == 'periodic':
         # Random from preferences
@@ -178,8 +208,8 @@ def generate_purchases_for_user(conn, user_id, profile, beverages, weeks=8):
     """
     Generate realistic purchase history for a user over N weeks
     """
-    cursor = conn.cursor()
     purchases = []
+    rows = []
 
     moods = profile['mood_preference']
     pattern = profile['pattern']
@@ -188,9 +218,18 @@ def generate_purchases_for_user(conn, user_id, profile, beverages, weeks=8):
     # Track favorite drinks for consistency
     favorite_drinks = {}
 
+    # Candidate pools depend only on profile and mood, so build them once
+    pools = build_profile_pools(beverages, profile)
+
+    # Weekend purchases (Saturday/Sunday) for periodic buyers
+    day_range = range(5, 7) if pattern == 'periodic' else range(7)
+    hour_range = range(7, 21)  # 7 AM to 8 PM
+    minute_range = range(60)
+    now = datetime.now()
+
     # Generate purchases week by week
     for week in range(weeks):
-        week_start = datetime.now() - timedelta(weeks=weeks-week)
+        week_start = now - timedelta(weeks=weeks-week)
         weekly_spent = 0.0
         weekly_purchases = 0
 
@@ -206,13 +245,19 @@ def generate_purchases_for_user(conn, user_id, profile, beverages, weeks=8):
         else:
             purchases_per_week = random.randint(4, 8)
 
-        for _ in range(purchases_per_week):
+        # Draw the week's moods and timestamps in bulk rather than per purchase
+        week_moods = random.choices(moods, k=purchases_per_week)
+        day_offsets = random.choices(day_range, k=purchases_per_week)
+        hours = random.choices(hour_range, k=purchases_per_week)
+        minutes = random.choices(minute_range, k=purchases_per_week)
+
+        for i in range(purchases_per_week):
             # Check budget constraint
             if weekly_spent >= weekly_budget * 0.95:  # Stop at 95% budget
                 break
 
             # Select mood
-            mood = random.choice(moods)
+            mood = week_moods[i]
 
             # Apply consistency - reuse favorite drinks
             if random.random() < profile['consistency'] and favorite_drinks:
@@ -220,7 +265,7 @@ def generate_purchases_for_user(conn, user_id, profile, beverages, weeks=8):
                 beverage = random.choice(list(favorite_drinks.values()))
             else:
                 # Select new beverage
-                beverage = select_beverage_for_profile(beverages, profile, mood)
+                beverage = select_beverage_for_profile(beverages, profile, mood, pools)
                 # Track as favorite
                 if beverage['id'] not in favorite_drinks:
                     favorite_drinks[beverage['id']] = beverage
@@ -234,22 +279,11 @@ def generate_purchases_for_user(conn, user_id, profile, beverages, weeks=8):
                 beverage = random.choice(cheaper)
 
             # Generate purchase date
-            if pattern == 'periodic':
-                # Weekend purchases (Saturday/Sunday)
-                day_offset = random.randint(5, 6)
-            else:
-                day_offset = random.randint(0, 6)
+            purchase_date = week_start + timedelta(days=day_offsets[i], hours=hours[i],
+                                                   minutes=minutes[i])
 
-            hour = random.randint(7, 20)  # 7 AM to 8 PM
-            minute = random.randint(0, 59)
-
-            purchase_date = week_start + timedelta(days=day_offset, hours=hour, minutes=minute)
-
-            # Insert purchase
-            cursor.execute("""
-                INSERT INTO purchases (user_id, beverage_id, mood, price, purchase_date)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, beverage['id'], mood, beverage['price'], purchase_date))
+            # Queue purchase for the batch insert
+            rows.append((user_id, beverage['id'], mood, beverage['price'], purchase_date))
 
             purchases.append({
                 'beverage': beverage['name'],
@@ -261,16 +295,32 @@ def generate_purchases_for_user(conn, user_id, profile, beverages, weeks=8):
             weekly_spent += beverage['price']
             weekly_purchases += 1
 
-    conn.commit()
+    # Insert all purchases in one statement and one transaction
+    with conn:
+        conn.executemany("""
+            INSERT INTO purchases (user_id, beverage_id, mood, price, purchase_date)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+
     return purchases
 
 
+def flush_output(lines):
+    """Write buffered output lines in a single call and clear the buffer"""
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        lines.clear()
+
+
 def main():
     """Main function to generate test users and data"""
 
-    print("=" * 80)
-    print("GENERATING TEST USERS FOR ML MODEL TRAINING")
-    print("=" * 80)
+    # Output is buffered and written once per section
+    out = []
+
+    out.append("=" * 80)
+    out.append("GENERATING TEST USERS FOR ML MODEL TRAINING")
+    out.append("=" * 80)
 
     # Connect to database
     conn = sqlite3.connect('starbucks_budget.db')
@@ -278,15 +328,20 @@ def main():
 
     # Fetch beverages
     beverages = get_beverages(conn)
-    print(f"\n✓ Loaded {len(beverages)} beverages from database")
+    out.append(f"\n✓ Loaded {len(beverages)} beverages from database")
+
+    flush_output(out)
 
     # Create test users
-    print(f"\n{'=' * 80}")
-    print(f"CREATING {len(USER_PROFILES)} TEST USERS")
-    print(f"{'=' * 80}\n")
+    out.append(f"\n{'=' * 80}")
+    out.append(f"CREATING {len(USER_PROFILES)} TEST USERS")
+    out.append(f"{'=' * 80}\n")
 
     user_stats = []
 
+    # Every test user shares one password, so hash it once
+    password_hash = hash_password(TEST_PASSWORD)
+
     for profile in USER_PROFILES:
         username = profile['username']
         email = profile['email']
@@ -298,24 +353,23 @@ def main():
 
         if existing:
             user_id = existing[0]
-            print(f"⚠️  User '{username}' already exists (ID: {user_id})")
+            out.append(f"⚠️  User '{username}' already exists (ID: {user_id})")
             # Delete existing purchases for clean slate
             cursor.execute("DELETE FROM purchases WHERE user_id = ?", (user_id,))
-            conn.commit()
-            print(f"   Cleared existing purchase history")
+            # Older runs stored a plain SHA-256 digest that login cannot verify
+            cursor.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+            out.append(f"   Cleared existing purchase history")
         else:
             # Create new user
-            password_hash = hash_password('test123')
             cursor.execute("""
                 INSERT INTO users (username, email, password_hash, weekly_budget)
                 VALUES (?, ?, ?, ?)
             """, (username, email, password_hash, weekly_budget))
-            conn.commit()
             user_id = cursor.lastrowid
-            print(f"✓ Created user '{username}' (ID: {user_id})")
+            out.append(f"✓ Created user '{username}' (ID: {user_id})")
 
         # Generate purchases
-        print(f"  Generating purchase history...")
+        out.append(f"  Generating purchase history...")
         purchases = generate_purchases_for_user(conn, user_id, profile, beverages, weeks=8)
 
         total_spent = sum(p['price'] for p in purchases)
@@ -333,32 +387,33 @@ def main():
             'consistency': profile['consistency']
         })
 
-        print(f"  ✓ Generated {len(purchases)} purchases over 8 weeks")
-        print(f"  - Total spent: ${total_spent:.2f}")
-        print(f"  - Avg price: ${avg_price:.2f}")
-        print(f"  - Unique drinks: {unique_drinks}")
-        print(f"  - Consistency score: {profile['consistency']:.2f}")
-        print()
+        out.append(f"  ✓ Generated {len(purchases)} purchases over 8 weeks")
+        out.append(f"  - Total spent: ${total_spent:.2f}")
+        out.append(f"  - Avg price: ${avg_price:.2f}")
+        out.append(f"  - Unique drinks: {unique_drinks}")
+        out.append(f"  - Consistency score: {profile['consistency']:.2f}")
+        out.append('')
+        flush_output(out)
 
     # Print summary
-    print(f"\n{'=' * 80}")
-    print("TRAINING DATA SUMMARY")
-    print(f"{'=' * 80}\n")
+    out.append(f"\n{'=' * 80}")
+    out.append("TRAINING DATA SUMMARY")
+    out.append(f"{'=' * 80}\n")
 
-    print(f"{'User':<25} {'Pattern':<12} {'Purchases':<10} {'Avg $':<8} {'Unique':<8}")
-    print("-" * 80)
+    out.append(f"{'User':<25} {'Pattern':<12} {'Purchases':<10} {'Avg $':<8} {'Unique':<8}")
+    out.append("-" * 80)
 
     for stat in user_stats:
-        print(f"{stat['username']:<25} {stat['pattern']:<12} {stat['purchases']:<10} "
+        out.append(f"{stat['username']:<25} {stat['pattern']:<12} {stat['purchases']:<10} "
               f"${stat['avg_price']:<7.2f} {stat['unique_drinks']:<8}")
 
-    print("-" * 80)
+    out.append("-" * 80)
     total_purchases = sum(s['purchases'] for s in user_stats)
-    print(f"{'TOTAL':<25} {'':<12} {total_purchases:<10}")
+    out.append(f"{'TOTAL':<25} {'':<12} {total_purchases:<10}")
 
-    print(f"\n{'=' * 80}")
-    print("DATABASE STATISTICS")
-    print(f"{'=' * 80}\n")
+    out.append(f"\n{'=' * 80}")
+    out.append("DATABASE STATISTICS")
+    out.append(f"{'=' * 80}\n")
 
     cursor.execute("SELECT COUNT(*) FROM users")
     total_users = cursor.fetchone()[0]
@@ -369,36 +424,37 @@ def main():
     cursor.execute("SELECT COUNT(*) FROM beverages")
     total_beverages = cursor.fetchone()[0]
 
-    print(f"Total Users: {total_users}")
-    print(f"Total Purchases: {total_db_purchases}")
-    print(f"Total Beverages: {total_beverages}")
+    out.append(f"Total Users: {total_users}")
+    out.append(f"Total Purchases: {total_db_purchases}")
+    out.append(f"Total Beverages: {total_beverages}")
 
     # Calculate some ML-relevant statistics
-    print(f"\n{'=' * 80}")
-    print("ML MODEL TRAINING READINESS")
-    print(f"{'=' * 80}\n")
+    out.append(f"\n{'=' * 80}")
+    out.append("ML MODEL TRAINING READINESS")
+    out.append(f"{'=' * 80}\n")
 
-    print("✓ MDP (Markov Decision Process):")
-    print("  - Budget states: 4 (HIGH, MEDIUM, LOW, CRITICAL)")
-    print(f"  - Training samples: {total_db_purchases} state-action pairs")
-    print(f"  - Users with diverse budgets: {len(set(s['budget'] for s in user_stats))}")
+    out.append("✓ MDP (Markov Decision Process):")
+    out.append("  - Budget states: 4 (HIGH, MEDIUM, LOW, CRITICAL)")
+    out.append(f"  - Training samples: {total_db_purchases} state-action pairs")
+    out.append(f"  - Users with diverse budgets: {len(set(s['budget'] for s in user_stats))}")
 
-    print("\n✓ CSP (Constraint Satisfaction Problem):")
-    print(f"  - Mood constraints: 4 types")
-    print(f"  - Category constraints: {len(set(b['category'] for b in beverages))} categories")
-    print(f"  - Budget constraints: {len(USER_PROFILES)} different budget levels")
+    out.append("\n✓ CSP (Constraint Satisfaction Problem):")
+    out.append(f"  - Mood constraints: 4 types")
+    out.append(f"  - Category constraints: {len(set(b['category'] for b in beverages))} categories")
+    out.append(f"  - Budget constraints: {len(USER_PROFILES)} different budget levels")
 
-    print("\n✓ Bayesian Inference:")
-    print(f"  - User profiles: {len(USER_PROFILES)} with varying consistency")
-    print(f"  - Purchase patterns: {total_db_purchases} observations")
-    print(f"  - Temporal data: 8 weeks of history per user")
+    out.append("\n✓ Bayesian Inference:")
+    out.append(f"  - User profiles: {len(USER_PROFILES)} with varying consistency")
+    out.append(f"  - Purchase patterns: {total_db_purchases} observations")
+    out.append(f"  - Temporal data: 8 weeks of history per user")
 
     avg_consistency = sum(s['consistency'] for s in user_stats) / len(user_stats)
-    print(f"  - Average user consistency: {avg_consistency:.2f}")
+    out.append(f"  - Average user consistency: {avg_consistency:.2f}")
 
-    print(f"\n{'=' * 80}")
-    print("✅ TEST DATA GENERATION COMPLETE!")
-    print(f"{'=' * 80}\n")
+    out.append(f"\n{'=' * 80}")
+    out.append("✅ TEST DATA GENERATION COMPLETE!")
+    out.append(f"{'=' * 80}\n")
+    flush_output(out)
 
     conn.close()
 
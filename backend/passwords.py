@@ -0,0 +1,48 @@
+"""
+Password hashing shared by the API and the scripts that seed users.
+
+New hashes are bcrypt over base64(sha256(password)), so bcrypt's 72-byte
+input limit never truncates a password, and are stored with a "sha256$"
+prefix. Unprefixed hashes predate pre-digesting and were made from the raw
+password. Each stored hash is checked against exactly one form of the input.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+
+import bcrypt
+
+# bcrypt work factor; existing hashes keep verifying since the cost is stored in them
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_COST', '10'))
+
+DIGEST_PREFIX = b'sha256$'
+
+
+def password_key(password):
+    """SHA-256 pre-digest of the password, base64-encoded for bcrypt."""
+    return base64.b64encode(hashlib.sha256(password.encode('utf-8')).digest())
+
+
+def hash_password(password):
+    """Prefixed bcrypt hash of the pre-digested password."""
+    return DIGEST_PREFIX + bcrypt.hashpw(password_key(password), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+
+def is_legacy_hash(password_hash):
+    """True for hashes made from the raw password, before pre-digesting."""
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode('utf-8')
+    return not password_hash.startswith(DIGEST_PREFIX)
+
+
+def check_password(password, password_hash):
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode('utf-8')
+    if password_hash.startswith(DIGEST_PREFIX):
+        password_hash = password_hash[len(DIGEST_PREFIX):]
+        candidate = password_key(password)
+    else:
+        candidate = password.encode('utf-8')
+    return hmac.compare_digest(bcrypt.hashpw(candidate, password_hash), password_hash)
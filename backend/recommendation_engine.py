@@ -1,13 +1,167 @@
 # recommendation_engine.py
 
+import atexit
+import bisect
+import functools
+import heapq
+import logging
 import math
+import orjson
 import requests
 import sqlite3
-from collections import defaultdict, deque
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from typing import List, Dict, Set, Tuple, Optional
 import numpy as np
+import services
+
+log = logging.getLogger(__name__)
 
 BACKEND_URL = "http://127.0.0.1:5001"
+BEVERAGES_URL = BACKEND_URL + "/api/beverages"
+HISTORY_URL = BACKEND_URL + "/api/purchase/history/%s"
+SPENDING_URL = BACKEND_URL + "/api/purchase/weekly-spending/%s"
+HTTP_TIMEOUT = (1.0, 2.0)  # (connect, read) seconds
+
+# Retry connection failures and gateway errors briefly, then give up; with the
+# timeouts above a stalled backend costs a bounded few seconds, not forever
+HTTP_RETRY = Retry(
+    total=2, connect=2, read=2, backoff_factor=0.05,
+    status_forcelist=(502, 503, 504), allowed_methods=("GET",)
+)
+
+# One pooled session for every backend call so recommend() reuses the same
+# keep-alive socket instead of handshaking for each request.
+SESSION = requests.Session()
+SESSION.headers.update({"Connection": "keep-alive"})
+SESSION.mount("http://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=8, max_retries=HTTP_RETRY
+))
+atexit.register(SESSION.close)
+
+# recommend() needs three independent GETs; run them side by side so the
+# wait is the slowest round trip rather than the sum of all three.
+_HTTP_EXECUTOR = ThreadPoolExecutor(max_workers=6, thread_name_prefix="backend-http")
+
+
+def _get_json(url):
+    return orjson.loads(SESSION.get(url, timeout=HTTP_TIMEOUT).content)
+
+
+# Mood-wide candidate lists from /api/beverages, reused for a short while so
+# repeat recommendations skip the round trip; the budget cap is applied locally
+CANDIDATE_CACHE_TTL = 60.0  # seconds
+_CANDIDATE_CACHE = {}  # mood -> (expires_at, beverages)
+_CANDIDATE_CACHE_LOCK = threading.Lock()
+
+DATABASE = 'starbucks_budget.db'
+_tls = threading.local()
+
+
+def _fallback_db():
+    """Per-thread connection for the direct-database fallback, opened once"""
+    conn = getattr(_tls, "conn", None)
+    if conn is None:
+        # mode=rw: a missing database is an error, not a new empty file
+        conn = sqlite3.connect(f"file:{DATABASE}?mode=rw", uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA mmap_size=67108864;"
+            "PRAGMA cache_size=-8000;"
+        )
+        _tls.conn = conn
+    return conn
+
+
+# Beverage catalog held in-process as parallel arrays so CSP candidates are
+# a mask over prices/moods instead of an HTTP round trip per recommendation.
+# (beverages, prices, mood_masks); None until first use, see load_catalog()
+_CATALOG = None
+_EMPTY_CATALOG = ([], np.empty(0, dtype=np.float64), {})
+_CATALOG_LOCK = threading.Lock()
+
+
+def _read_catalog():
+    """The catalog as load_catalog() caches it, or None if it can't be read"""
+    try:
+        conn = _fallback_db()
+        rows = conn.execute(
+            "SELECT id, name, category, price, suitable_moods FROM beverages ORDER BY id"
+        ).fetchall()
+        mood_rows = conn.execute("SELECT mood, beverage_id FROM beverage_moods").fetchall()
+    except sqlite3.Error as e:
+        log.error("ERROR loading beverage catalog: %s", e)
+        return None
+
+    # Same shape as the /api/beverages payload
+    beverages = [{
+        'id': r['id'],
+        'name': r['name'],
+        'category': r['category'],
+        'price': r['price'],
+        'suitable_moods': r['suitable_moods'].split(',') if r['suitable_moods'] else []
+    } for r in rows]
+    prices = np.fromiter((b['price'] for b in beverages), dtype=np.float64, count=len(beverages))
+
+    position = {b['id']: i for i, b in enumerate(beverages)}
+    mood_masks = {}
+    for mood, beverage_id in mood_rows:
+        mask = mood_masks.get(mood.lower())
+        if mask is None:
+            mask = mood_masks[mood.lower()] = np.zeros(len(beverages), dtype=bool)
+        if beverage_id in position:
+            mask[position[beverage_id]] = True
+
+    return beverages, prices, mood_masks
+
+
+# Every mood string seen in a suitable_moods list gets its own bit, so a
+# drink's moods become one int and the CSP mood check is a shift-and-test.
+# Case-sensitive, like the list membership test it replaces.
+MOOD_BITS = {}
+_MOOD_BITMASKS = {}  # tuple(suitable_moods) -> bitmask
+_MOOD_BITS_LOCK = threading.Lock()
+
+
+def mood_bitmask(moods):
+    """Bitmask of a suitable_moods list, assigning bits to new moods"""
+    key = tuple(moods)
+    mask = _MOOD_BITMASKS.get(key)
+    if mask is None:
+        with _MOOD_BITS_LOCK:
+            mask = 0
+            for mood in key:
+                mask |= 1 << MOOD_BITS.setdefault(mood, len(MOOD_BITS))
+            _MOOD_BITMASKS[key] = mask
+    return mask
+
+
+def load_catalog():
+    """Load the beverage catalog from the database on first use"""
+    global _CATALOG
+    if _CATALOG is None:
+        with _CATALOG_LOCK:
+            if _CATALOG is None:
+                # A failed read isn't cached, so the next call retries
+                catalog = _read_catalog()
+                if catalog is None:
+                    return _EMPTY_CATALOG
+                _CATALOG = catalog
+    return _CATALOG
+
+
+def refresh_catalog():
+    """Forget the loaded catalog; the next recommendation reloads it"""
+    global _CATALOG
+    with _CATALOG_LOCK:
+        _CATALOG = None
 
 # -------------------------------------------------------------
 # 1. ADVANCED CSP FILTERING (Constraint Satisfaction Problem)
@@ -44,30 +198,23 @@ class CSPFilter:
 
         Ensures arc consistency across all constraints.
         Removes values from domains that can never be part of a consistent solution.
-        """
-        queue = deque(constraints)
-        consistent_candidates = candidates.copy()
-        revision_count = 0
-
-        while queue:
-            constraint = queue.popleft()
-            revised = self._revise(consistent_candidates, constraint)
 
-            if revised:
-                revision_count += 1
-                # Domain wipeout - no solution exists
-                if len(consistent_candidates) == 0:
-                    return []
+        Every constraint here is unary (it tests one drink at a time), so a
+        single revision per constraint already reaches the AC-3 fixpoint.
+        Each revision is a boolean keep-mask over all candidates; the masks
+        are ANDed and the survivors gathered once, in their original order.
+        """
+        if not candidates:
+            return []
 
-                # Add related constraints back to queue for re-checking
-                # This ensures full propagation
-                for other_constraint in constraints:
-                    if other_constraint != constraint and other_constraint not in queue:
-                        # Check if constraints are related (share variables)
-                        if self._constraints_related(constraint, other_constraint):
-                            queue.append(other_constraint)
+        keep = np.ones(len(candidates), dtype=bool)
+        for constraint in constraints:
+            keep &= self._constraint_mask(candidates, constraint)
+            # Domain wipeout - no solution exists
+            if not keep.any():
+                return []
 
-        return consistent_candidates
+        return [candidates[i] for i in np.flatnonzero(keep)]
 
     def _constraints_related(self, c1, c2):
         """
@@ -83,43 +230,94 @@ class CSPFilter:
         # Constraints are related if they could interact
         return len(c1_attrs.intersection(c2_attrs)) > 0 or True  # Conservative: assume all related
     
-    def _revise(self, candidates, constraint):
-        """Helper for AC-3: revise domain based on constraint"""
-        revised = False
-        to_remove = []
-        
-        for drink in candidates:
-            if not self._satisfies_constraint(drink, constraint):
-                to_remove.append(drink)
-                revised = True
-        
-        for drink in to_remove:
-            candidates.remove(drink)
-        
-        return revised
-    
-    def _satisfies_constraint(self, drink, constraint):
-        """Check if a drink satisfies a specific constraint"""
+    def _constraint_mask(self, candidates, constraint):
+        """AC-3 revise step: which candidates satisfy one constraint"""
         c_type = constraint['type']
         params = constraint['params']
-        
+        n = len(candidates)
+
         if c_type == 'mood':
-            moods = drink.get('suitable_moods', [])
-            return params['mood'] in moods
+            masks = [mood_bitmask(d.get('suitable_moods', [])) for d in candidates]
+            bit = MOOD_BITS.get(params['mood'])
+            if bit is None:
+                # No candidate lists this mood
+                return np.zeros(n, dtype=bool)
+            if len(MOOD_BITS) <= 64:
+                masks = np.array(masks, dtype=np.uint64)
+                return ((masks >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+            return np.array([(m >> bit) & 1 for m in masks], dtype=bool)
         elif c_type == 'budget':
-            return drink['price'] <= params['max_price']
+            prices = np.fromiter((d['price'] for d in candidates), dtype=np.float64, count=n)
+            return prices <= params['max_price']
         elif c_type == 'exclude':
-            return drink['name'] not in params['exclude_list']
-        elif c_type == 'category_diversity':
-            # Satisfied by post-processing
-            return True
-        
-        return True
+            exclude = params['exclude_list']
+            if isinstance(exclude, (list, tuple)):
+                # One hash lookup per drink instead of a scan of the list
+                exclude = set(exclude)
+            return np.fromiter((d['name'] not in exclude for d in candidates),
+                               dtype=bool, count=n)
+
+        # category_diversity is satisfied by post-processing
+        return np.ones(n, dtype=bool)
+    
+    def _satisfies_constraint(self, drink, constraint):
+        """Check if a drink satisfies a specific constraint"""
+        return bool(self._constraint_mask([drink], constraint)[0])
     
     @staticmethod
-    def filter_beverages(mood, budget, user_preferences=None, exclude_recent=None):
+    def fetch_candidates(mood, budget):
+        """Fetch the mood/price-matching beverages from the backend"""
+        # Same cap the endpoint's max_price applies (unparsable or 0 = no cap)
+        try:
+            max_price = float(budget)
+        except (TypeError, ValueError):
+            max_price = None
+
+        beverages, prices, mood_masks = load_catalog()
+        if beverages:
+            # Mood key as it would arrive in the query string (empty = any mood)
+            mood_key = str(mood)
+            mask = np.ones(len(beverages), dtype=bool)
+            if mood_key:
+                mask &= mood_masks.get(mood_key.lower(), False)
+            if max_price:
+                mask &= prices <= max_price
+            # Copies, since the CSP passes annotate the drink dicts in place
+            return [dict(beverages[i]) for i in np.flatnonzero(mask)]
+
+        # No local catalog (e.g. run away from the database): ask the backend
+        now = time.monotonic()
+        with _CANDIDATE_CACHE_LOCK:
+            cached = _CANDIDATE_CACHE.get(mood)
+
+        if cached is not None and cached[0] > now:
+            beverages = cached[1]
+        else:
+            try:
+                # mood as text, like the in-process filter (None stays "None")
+                response = SESSION.get(BEVERAGES_URL, params={"mood": str(mood)},
+                                       timeout=HTTP_TIMEOUT)
+                data = orjson.loads(response.content)
+                beverages = data.get("beverages", [])
+            except requests.exceptions.Timeout:
+                log.error("ERROR in CSP filter: backend timed out")
+                return []
+            except Exception as e:
+                log.error("ERROR in CSP filter: %s", e)
+                return []
+            with _CANDIDATE_CACHE_LOCK:
+                _CANDIDATE_CACHE[mood] = (now + CANDIDATE_CACHE_TTL, beverages)
+
+        return [dict(b) for b in beverages if not max_price or b['price'] <= max_price]
+
+    @staticmethod
+    def filter_beverages(mood, budget, user_preferences=None, exclude_recent=None,
+                         candidates=None):
         """
         Advanced multi-constraint filtering with AC-3 and forward checking
+
+        Pass ``candidates`` when they were already fetched (e.g. concurrently
+        with other backend calls) to skip the HTTP request.
         """
         csp = CSPFilter()
         
@@ -136,14 +334,8 @@ class CSPFilter:
             })
         
         # Fetch initial candidates
-        try:
-            url = f"{BACKEND_URL}/api/beverages?mood={mood}&max_price={budget}"
-            response = requests.get(url)
-            data = response.json()
-            candidates = data.get("beverages", [])
-        except Exception as e:
-            print("ERROR in CSP filter:", e)
-            candidates = []
+        if candidates is None:
+            candidates = CSPFilter.fetch_candidates(mood, budget)
         
         if not candidates:
             return []
@@ -202,37 +394,50 @@ class CSPFilter:
         - Look-ahead to prevent dead ends
         - Balanced distribution using max-min fairness
         """
-        categories = defaultdict(list)
-        for drink in candidates:
-            category = drink.get('category', 'Other')
-            categories[category].append(drink)
+        # Group drinks by category as integer positions: category ids in order
+        # of first appearance, positions sorted stably by id so each category
+        # is one contiguous slice of `order` (bounded by `offsets`)
+        category_ids = {}
+        drink_categories = np.fromiter(
+            (category_ids.setdefault(drink.get('category', 'Other'), len(category_ids))
+             for drink in candidates),
+            dtype=np.intp, count=len(candidates)
+        )
 
         # Calculate optimal distribution
         total_drinks = len(candidates)
-        num_categories = len(categories)
+        num_categories = len(category_ids)
 
         if num_categories == 0:
             return candidates
 
+        order = np.argsort(drink_categories, kind='stable')
+        sizes = np.bincount(drink_categories, minlength=num_categories)
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+
         # Enhanced diversity strategy using max-min fairness
         # Ensure minimum representation from each category
         min_per_category = max(1, total_drinks // (num_categories * 3))
         max_per_category = max(3, total_drinks // num_categories + 2)
 
-        balanced_results = []
+        selected = []  # positions into candidates, in output order
         remaining_slots = total_drinks
 
         # Apply MRV heuristic - process categories with fewer options first
-        sorted_categories = self.minimum_remaining_values(categories)
+        # (stable, so equal-sized categories keep first-appearance order)
+        sorted_categories = np.argsort(sizes, kind='stable').tolist()
+        sizes = sizes.tolist()
+        offsets = offsets.tolist()
+        order = order.tolist()
 
         # First pass: Ensure minimum representation (max-min fairness)
-        category_counts = defaultdict(int)
+        category_counts = [0] * num_categories
 
-        for category, drinks in sorted_categories:
+        for category in sorted_categories:
             # Take minimum required from each category
-            take = min(len(drinks), min_per_category, remaining_slots)
-            selected = drinks[:take]
-            balanced_results.extend(selected)
+            take = min(sizes[category], min_per_category, remaining_slots)
+            start = offsets[category]
+            selected.extend(order[start:start + take])
             category_counts[category] += take
             remaining_slots -= take
 
@@ -242,32 +447,40 @@ class CSPFilter:
         # Second pass: Distribute remaining slots fairly
         # Use round-robin to maintain balance
         if remaining_slots > 0:
-            round_robin_idx = 0
-            category_list = list(sorted_categories)
+            # Categories still taking drinks; the front one is next in turn
+            active = deque(sorted_categories)
 
-            while remaining_slots > 0 and category_list:
-                category, drinks = category_list[round_robin_idx % len(category_list)]
+            while remaining_slots > 0 and active:
+                category = active[0]
 
                 # Check if we can add more from this category
                 already_selected = category_counts[category]
-                available = drinks[already_selected:]
 
-                if available and already_selected < max_per_category:
+                if already_selected < sizes[category] and already_selected < max_per_category:
                     # Add one more drink from this category
-                    balanced_results.append(available[0])
+                    selected.append(order[offsets[category] + already_selected])
                     category_counts[category] += 1
                     remaining_slots -= 1
-                    round_robin_idx += 1
+                    active.rotate(-1)
                 else:
-                    # Remove exhausted category
-                    category_list.pop(round_robin_idx % len(category_list))
-                    if not category_list:
-                        break
+                    # Remove exhausted category; its successor is up next
+                    active.popleft()
 
         # Third pass: If still need more, relax constraints
+        # (skipping chosen drinks and any listing equal to one; equal dicts
+        # share (category, price), so only that group is compared)
         if remaining_slots > 0:
-            remaining = [d for d in candidates if d not in balanced_results]
-            balanced_results.extend(remaining[:remaining_slots])
+            chosen = defaultdict(list)
+            for i in selected:
+                drink = candidates[i]
+                chosen[(drink.get('category'), drink.get('price'))].append(drink)
+            remaining = [
+                i for i, drink in enumerate(candidates)
+                if drink not in chosen.get((drink.get('category'), drink.get('price')), ())
+            ]
+            selected.extend(remaining[:remaining_slots])
+
+        balanced_results = [candidates[i] for i in selected]
 
         return balanced_results
     
@@ -278,26 +491,52 @@ class CSPFilter:
         Choose the value (drink) that leaves maximum flexibility for future choices.
         This value rules out the fewest options for remaining variables.
         """
-        # Count how many future options this drink would eliminate
-        constraints_imposed = 0
+        return self._lcv_scores([drink, *remaining_candidates])[0]
 
-        # Check category constraint
-        drink_category = drink.get('category', 'Other')
-        same_category_count = sum(1 for d in remaining_candidates
-                                 if d.get('category') == drink_category and d != drink)
+    def _lcv_scores(self, candidates):
+        """
+        LCV score of every candidate against the drinks after it, in one
+        backward sweep: the suffix is kept as category counts and a sorted
+        price list instead of being rescanned for each drink.
 
-        # Fewer same-category drinks = more constraining
-        constraints_imposed += max(0, 5 - same_category_count)
+        A drink is penalised by how far it falls short of five same-category
+        and five similar-price (within $1.50) drinks among the rest; copies
+        of the drink itself don't count. Lower penalty scores higher.
+        """
+        scores = [0] * len(candidates)
+        category_counts = Counter()
+        suffix_prices = []
+        # (category, price) -> later drinks, for the `d != drink` exclusion
+        suffix_drinks = defaultdict(list)
+
+        for idx in range(len(candidates) - 1, -1, -1):
+            drink = candidates[idx]
+            category = drink.get('category')
+            price = drink.get('price', 0)
+
+            same_category_count = category_counts[drink.get('category', 'Other')]
+            # |d - price| < 1.5 is a contiguous run of the sorted prices
+            similar_price_count = (
+                bisect.bisect_left(suffix_prices, 1.5, key=lambda p: p - price) -
+                bisect.bisect_right(suffix_prices, -1.5, key=lambda p: p - price)
+            )
 
-        # Check price constraint
-        drink_price = drink.get('price', 0)
-        similar_price_count = sum(1 for d in remaining_candidates
-                                 if abs(d.get('price', 0) - drink_price) < 1.5 and d != drink)
+            # Later copies of this same drink were counted but don't count
+            key = (category, price)
+            duplicates = sum(1 for d in suffix_drinks[key] if d == drink)
+            if duplicates:
+                similar_price_count -= duplicates
+                if category == drink.get('category', 'Other'):
+                    same_category_count -= duplicates
+
+            scores[idx] = -(max(0, 5 - same_category_count) +
+                            max(0, 5 - similar_price_count))
 
-        constraints_imposed += max(0, 5 - similar_price_count)
+            category_counts[category] += 1
+            bisect.insort(suffix_prices, price)
+            suffix_drinks[key].append(drink)
 
-        # Lower constraint score is better (less constraining)
-        return -constraints_imposed
+        return scores
 
     def _apply_value_ordering(self, candidates, user_preferences):
         """
@@ -309,58 +548,55 @@ class CSPFilter:
         if not candidates:
             return candidates
 
-        # Score based on multiple criteria
-        for idx, drink in enumerate(candidates):
-            scores = {
-                'preference': 0.0,
-                'lcv': 0.0,
-                'diversity': 0.0
-            }
-
-            # User preference score
-            if user_preferences:
-                pref_categories = user_preferences.get('preferred_categories', [])
-                pref_max_price = user_preferences.get('preferred_max_price', float('inf'))
-
-                if drink.get('category') in pref_categories:
-                    scores['preference'] += 0.5
-                if drink['price'] <= pref_max_price:
-                    scores['preference'] += 0.3
-                # Bonus for exact preference match
-                if (drink.get('category') in pref_categories and
-                    drink['price'] <= pref_max_price):
-                    scores['preference'] += 0.2
-
-            # LCV score (least constraining)
-            remaining = candidates[idx+1:] if idx < len(candidates) - 1 else []
-            scores['lcv'] = self.least_constraining_value(
-                drink, remaining, self.constraints
-            )
+        n = len(candidates)
+        categories = [drink.get('category') for drink in candidates]
+
+        # Preference score
+        preference = np.zeros(n)
+        if user_preferences:
+            pref_categories = user_preferences.get('preferred_categories', [])
+            pref_max_price = user_preferences.get('preferred_max_price', float('inf'))
+
+            preferred = {c: c in pref_categories for c in set(categories)}
+            in_pref_category = np.fromiter((preferred[c] for c in categories),
+                                           dtype=bool, count=n)
+            within_pref_price = np.fromiter((d['price'] for d in candidates),
+                                            dtype=np.float64, count=n) <= pref_max_price
+
+            preference += 0.5 * in_pref_category
+            preference += 0.3 * within_pref_price
+            # Bonus for exact preference match
+            preference += 0.2 * (in_pref_category & within_pref_price)
+
+        # LCV score (least constraining)
+        lcv = np.array(self._lcv_scores(candidates), dtype=np.float64)
+
+        # Diversity score: different from the categories of the first three
+        # candidates (only those before it, for the first three themselves)
+        diversity = np.fromiter(
+            (-0.1 if category in categories[:min(idx, 3)] else 0.3
+             for idx, category in enumerate(categories)),
+            dtype=np.float64, count=n
+        )
 
-            # Diversity score (different from already selected)
-            selected_categories = [candidates[i].get('category')
-                                  for i in range(min(idx, 3))]
-            if drink.get('category') not in selected_categories:
-                scores['diversity'] = 0.3
-            else:
-                scores['diversity'] = -0.1
-
-            # Combined score with adaptive weighting
-            weight_pref = 0.5 if user_preferences else 0.2
-            weight_lcv = 0.3
-            weight_div = 0.2
-
-            total_weight = weight_pref + weight_lcv + weight_div
-            final_score = (
-                (weight_pref * scores['preference'] +
-                 weight_lcv * (scores['lcv'] / 10.0) +  # Normalize LCV
-                 weight_div * scores['diversity']) / total_weight
-            )
+        # Combined score with adaptive weighting
+        weight_pref = 0.5 if user_preferences else 0.2
+        weight_lcv = 0.3
+        weight_div = 0.2
 
+        total_weight = weight_pref + weight_lcv + weight_div
+        final_scores = (
+            (weight_pref * preference +
+             weight_lcv * (lcv / 10.0) +  # Normalize LCV
+             weight_div * diversity) / total_weight
+        )
+
+        for drink, final_score in zip(candidates, final_scores.tolist()):
             drink['csp_ordering_score'] = final_score
 
-        # Sort by combined score (higher is better)
-        candidates.sort(key=lambda x: x.get('csp_ordering_score', 0), reverse=True)
+        # Sort by combined score (higher is better; ties keep their order)
+        order = np.argsort(-final_scores, kind='stable')
+        candidates[:] = [candidates[i] for i in order.tolist()]
 
         return candidates
 
@@ -404,6 +640,10 @@ class BayesianPredictor:
             'afternoon': defaultdict(lambda: 1.0),
             'evening': defaultdict(lambda: 1.0)
         }
+
+        # (history_data, all_drink_names, context) for the batch currently
+        # being scored, see _batch_context()
+        self._batch = None
     
     @staticmethod
     def compute_hierarchical_prior(all_drinks, global_popularity=None, user_data=None):
@@ -418,12 +658,12 @@ class BayesianPredictor:
         """
         if global_popularity is None:
             # Weakly informative uniform prior
-            return {drink: 1.0 for drink in all_drinks}
+            return dict.fromkeys(all_drinks, 1.0)
 
         # Empirical Bayes: Estimate hyperparameters from data
         total_popularity = sum(global_popularity.values())
         if total_popularity == 0:
-            return {drink: 1.0 for drink in all_drinks}
+            return dict.fromkeys(all_drinks, 1.0)
 
         # Calculate method of moments estimators for Dirichlet parameters
         # More sophisticated than simple scaling
@@ -438,6 +678,10 @@ class BayesianPredictor:
         else:
             precision = 10.0
 
+        if user_data:
+            # Blend weight for user-specific information
+            user_weight = min(0.5, len(user_data) / 20.0)  # Caps at 50% with 20+ purchases
+
         # Compute Dirichlet parameters
         priors = {}
         for drink in all_drinks:
@@ -451,7 +695,6 @@ class BayesianPredictor:
             if user_data:
                 user_count = user_data.get(drink, 0)
                 # Blend global and user-specific information
-                user_weight = min(0.5, len(user_data) / 20.0)  # Caps at 50% with 20+ purchases
                 base_alpha = (1 - user_weight) * base_alpha + user_weight * (user_count + 1)
 
             priors[drink] = max(0.5, base_alpha)  # Ensure minimum prior
@@ -507,33 +750,50 @@ class BayesianPredictor:
         
         return consistency
     
-    def bayesian_posterior_dirichlet(self, drink_name, history_data, all_drink_names, priors):
-        """
-        Compute posterior using Dirichlet-Multinomial conjugate prior
-        
-        This is the theoretically correct Bayesian update:
-        Posterior Dir(α + counts) where α is prior concentration
-        
-        Returns: Expected probability under posterior distribution
-        """
+    def _weighted_totals(self, history_data, all_drink_names, priors):
+        """Temporally weighted purchase counts and the posterior mass Σα"""
         # Compute user consistency for adaptive weighting
         user_consistency = self.compute_user_consistency(history_data)
         
-        # Count weighted occurrences
+        # Count weighted occurrences; purchases share a handful of ages, so
+        # each distinct age's decay weight is computed once
+        decay_weights = {}
         weighted_counts = defaultdict(float)
         for item in history_data:
             drink = item.get('beverage_name')
             days_ago = item.get('days_ago', 0)
-            weight = self.adaptive_temporal_weight(days_ago, user_consistency)
+            weight = decay_weights.get(days_ago)
+            if weight is None:
+                weight = decay_weights[days_ago] = self.adaptive_temporal_weight(
+                    days_ago, user_consistency
+                )
             weighted_counts[drink] += weight
         
-        # Dirichlet posterior parameters
-        posterior_alpha = priors.get(drink_name, 1.0) + weighted_counts.get(drink_name, 0)
-        
         # Sum of all posterior alphas (normalization)
         total_alpha = sum(priors.get(d, 1.0) + weighted_counts.get(d, 0) 
                          for d in all_drink_names)
         
+        return weighted_counts, total_alpha
+
+    def bayesian_posterior_dirichlet(self, drink_name, history_data, all_drink_names, priors,
+                                     totals=None):
+        """
+        Compute posterior using Dirichlet-Multinomial conjugate prior
+        
+        This is the theoretically correct Bayesian update:
+        Posterior Dir(α + counts) where α is prior concentration
+        
+        ``totals`` is an optional precomputed (weighted_counts, total_alpha).
+
+        Returns: Expected probability under posterior distribution
+        """
+        if totals is None:
+            totals = self._weighted_totals(history_data, all_drink_names, priors)
+        weighted_counts, total_alpha = totals
+        
+        # Dirichlet posterior parameters
+        posterior_alpha = priors.get(drink_name, 1.0) + weighted_counts.get(drink_name, 0)
+        
         # Expected probability under Dirichlet posterior
         posterior_prob = posterior_alpha / total_alpha
         
@@ -567,29 +827,63 @@ class BayesianPredictor:
 
         return thompson_score
 
-    def beta_bernoulli_preference(self, drink_name, history_data):
+    def beta_bernoulli_preference(self, drink_name, history_data, purchase_counts=None):
         """
         Beta-Bernoulli model for binary preference learning
 
         Models: P(user likes drink | history)
 
+        ``purchase_counts`` (drink name -> purchases in history_data) saves a
+        pass over the history when the caller has already counted it.
+
         Returns: (alpha, beta) posterior parameters
         """
         # Prior: Beta(1, 1) - uniform
         alpha = self.hyperprior_alpha
         beta = self.hyperprior_beta
 
-        # Update based on purchase history
-        for item in history_data:
-            if item.get('beverage_name') == drink_name:
-                # Success: user purchased this drink
-                alpha += 1
-            # We don't explicitly model rejections in this data
-            # but could infer from browsing data
+        # Update based on purchase history: each purchase of this drink is a
+        # success. We don't explicitly model rejections in this data
+        # but could infer from browsing data
+        if purchase_counts is None:
+            purchase_counts = Counter(item.get('beverage_name') for item in history_data)
+        alpha += purchase_counts.get(drink_name, 0)
 
         return alpha, beta
 
-    def multi_modal_likelihood(self, drink, history_data, current_mood, current_context=None):
+    @staticmethod
+    def history_profile(history_data):
+        """
+        Drink-independent aggregates of a purchase history used by
+        multi_modal_likelihood(): mood and category tallies and the robust
+        price centre/spread. Computed once per scoring batch.
+        """
+        mood_counts = Counter(item.get('mood', '') for item in history_data)
+        category_counts = Counter(item.get('category', 'Other') for item in history_data)
+
+        historical_prices = np.fromiter((item.get('price', 0) for item in history_data),
+                                        dtype=np.float64, count=len(history_data))
+        if historical_prices.size:
+            # Robust statistics (use median and MAD for outlier resistance);
+            # the upper middle element by selection rather than a full sort
+            middle = historical_prices.size // 2
+            median_price = float(np.partition(historical_prices, middle)[middle])
+            mad = np.median(np.abs(historical_prices - median_price))
+            price_std = mad * 1.4826 if mad > 0 else np.std(historical_prices)  # MAD to std conversion
+        else:
+            median_price = price_std = None
+
+        return {
+            'mood_counts': mood_counts,
+            'total_mood_purchases': sum(mood_counts.values()),
+            'category_counts': category_counts,
+            'total_category_purchases': sum(category_counts.values()),
+            'median_price': median_price,
+            'price_std': price_std,
+        }
+
+    def multi_modal_likelihood(self, drink, history_data, current_mood, current_context=None,
+                               profile=None):
         """
         Enhanced multi-modal likelihood with:
         - Mood compatibility (categorical)
@@ -600,18 +894,21 @@ class BayesianPredictor:
         - Weather sensitivity (if available)
 
         Uses product of experts approach
+
+        ``profile`` is history_profile(history_data), if already computed.
         """
         if len(history_data) == 0:
             return 1.0
 
+        if profile is None:
+            profile = self.history_profile(history_data)
+
         likelihood_components = {}
 
         # 1. Mood compatibility (Categorical likelihood)
-        mood_counts = defaultdict(int)
-        for item in history_data:
-            mood_counts[item.get('mood', '')] += 1
+        mood_counts = profile['mood_counts']
 
-        total_mood_purchases = sum(mood_counts.values())
+        total_mood_purchases = profile['total_mood_purchases']
         if total_mood_purchases > 0:
             # Laplace smoothing
             mood_prior = 0.1
@@ -624,14 +921,10 @@ class BayesianPredictor:
 
         # 2. Price sensitivity (Gaussian likelihood with robust estimation)
         drink_price = drink.get('price', 0)
-        historical_prices = [item.get('price', 0) for item in history_data]
-
-        if historical_prices:
-            # Robust statistics (use median and MAD for outlier resistance)
-            median_price = sorted(historical_prices)[len(historical_prices) // 2]
-            mad = np.median([abs(p - median_price) for p in historical_prices])
-            price_std = mad * 1.4826 if mad > 0 else np.std(historical_prices)  # MAD to std conversion
+        median_price = profile['median_price']
+        price_std = profile['price_std']
 
+        if median_price is not None:
             if price_std > 0:
                 # Gaussian likelihood
                 price_likelihood = math.exp(-0.5 * ((drink_price - median_price) / price_std) ** 2)
@@ -643,11 +936,9 @@ class BayesianPredictor:
 
         # 3. Category preference (Multinomial likelihood)
         drink_category = drink.get('category', 'Other')
-        category_counts = defaultdict(int)
-        for item in history_data:
-            category_counts[item.get('category', 'Other')] += 1
+        category_counts = profile['category_counts']
 
-        total_category_purchases = sum(category_counts.values())
+        total_category_purchases = profile['total_category_purchases']
         if total_category_purchases > 0:
             category_prior = 0.05
             category_likelihood = (category_counts.get(drink_category, 0) + category_prior) / (
@@ -699,25 +990,21 @@ class BayesianPredictor:
 
         return max(combined_likelihood, 0.001)  # Avoid zero likelihood
     
-    def credible_interval(self, drink_name, history_data, all_drink_names, priors, confidence=0.95):
+    def credible_interval(self, drink_name, history_data, all_drink_names, priors, confidence=0.95,
+                          totals=None):
         """
         Compute Bayesian credible interval for uncertainty quantification
 
+        ``totals`` is an optional precomputed (weighted_counts, total_alpha).
+
         Returns: (lower_bound, upper_bound, width)
         """
         # Get posterior parameters
-        weighted_counts = defaultdict(float)
-        user_consistency = self.compute_user_consistency(history_data)
-
-        for item in history_data:
-            drink = item.get('beverage_name')
-            days_ago = item.get('days_ago', 0)
-            weight = self.adaptive_temporal_weight(days_ago, user_consistency)
-            weighted_counts[drink] += weight
+        if totals is None:
+            totals = self._weighted_totals(history_data, all_drink_names, priors)
+        weighted_counts, total_alpha = totals
 
         posterior_alpha = priors.get(drink_name, 1.0) + weighted_counts.get(drink_name, 0)
-        total_alpha = sum(priors.get(d, 1.0) + weighted_counts.get(d, 0)
-                         for d in all_drink_names)
 
         # Approximate credible interval using normal approximation
         # (valid for large alpha values)
@@ -736,6 +1023,39 @@ class BayesianPredictor:
 
         return lower, upper, width
 
+    def prepare_context(self, history_data, all_drink_names):
+        """
+        Everything bayesian_score() needs that does not depend on the drink
+        being scored: purchase counts, hierarchical priors, temporally
+        weighted counts with Σα (which fold in the user's consistency) and
+        the likelihood's history profile.
+        """
+        # Compute hierarchical priors with user-specific adjustments
+        user_drink_counts = Counter(item.get('beverage_name') for item in history_data)
+
+        priors = self.compute_hierarchical_prior(
+            all_drink_names,
+            global_popularity=None,  # Could load from database
+            user_data=user_drink_counts
+        )
+
+        return {
+            'user_drink_counts': user_drink_counts,
+            'priors': priors,
+            'totals': self._weighted_totals(history_data, all_drink_names, priors),
+            'profile': self.history_profile(history_data),
+        }
+
+    def _batch_context(self, history_data, all_drink_names):
+        """prepare_context(), reused while the same history and name lists are scored"""
+        batch = self._batch
+        if batch is not None and batch[0] is history_data and batch[1] is all_drink_names:
+            return batch[2]
+
+        context = self.prepare_context(history_data, all_drink_names)
+        self._batch = (history_data, all_drink_names, context)
+        return context
+
     def bayesian_score(self, drink_name, drink_obj, history_data, all_drink_names,
                       current_mood, current_context=None):
         """
@@ -748,34 +1068,31 @@ class BayesianPredictor:
 
         Returns: P(drink | user, context) using full Bayesian inference
         """
-        # Compute hierarchical priors with user-specific adjustments
-        user_drink_counts = defaultdict(int)
-        for item in history_data:
-            user_drink_counts[item.get('beverage_name')] += 1
-
-        priors = self.compute_hierarchical_prior(
-            all_drink_names,
-            global_popularity=None,  # Could load from database
-            user_data=dict(user_drink_counts)
-        )
+        # Counts, priors, Σα and history aggregates are shared by every drink
+        # in the batch, so they are computed on the first call only
+        batch = self._batch_context(history_data, all_drink_names)
+        user_drink_counts = batch['user_drink_counts']
+        priors = batch['priors']
+        totals = batch['totals']
 
         # Posterior from Dirichlet-Multinomial
         posterior_prob = self.bayesian_posterior_dirichlet(
-            drink_name, history_data, all_drink_names, priors
+            drink_name, history_data, all_drink_names, priors, totals
         )
 
         # Multi-modal likelihood with context
         context_likelihood = self.multi_modal_likelihood(
-            drink_obj, history_data, current_mood, current_context
+            drink_obj, history_data, current_mood, current_context,
+            profile=batch['profile']
         )
 
         # Thompson sampling for exploration-exploitation
-        alpha, beta = self.beta_bernoulli_preference(drink_name, history_data)
+        alpha, beta = self.beta_bernoulli_preference(drink_name, history_data, user_drink_counts)
         thompson_score = self.thompson_sampling(drink_name, alpha, beta)
 
         # Uncertainty quantification
         lower, upper, uncertainty_width = self.credible_interval(
-            drink_name, history_data, all_drink_names, priors
+            drink_name, history_data, all_drink_names, priors, totals=totals
         )
 
         # Bayesian model averaging with adaptive weights
@@ -834,8 +1151,35 @@ class MDPOptimizer:
     EPSILON_GREEDY = 0.15
     EPSILON_DECAY = 0.995
     MIN_EPSILON = 0.05
+
+    # Discrete budget states by spent/budget ratio: below 0.35 is HIGH, from
+    # 0.35 MEDIUM, from 0.65 LOW, from 0.85 CRITICAL
+    BUDGET_STATES = ("HIGH", "MEDIUM", "LOW", "CRITICAL")
+    BUDGET_STATE_THRESHOLDS = (0.35, 0.65, 0.85)
+
+    # Representative share of the weekly budget already spent in each state
+    STATE_SPENDING_RATIO = {
+        "CRITICAL": 0.90, "LOW": 0.75,
+        "MEDIUM": 0.50, "HIGH": 0.25
+    }
+
+    # Budget ratio a next state is mapped back to when looking up state
+    # values and option values
+    NEXT_STATE_RATIO = {
+        "HIGH": 0.2, "MEDIUM": 0.5,
+        "LOW": 0.75, "CRITICAL": 0.95
+    }
+
+    # Heuristic value of landing in each budget state (q_learning_score)
+    NEXT_STATE_VALUE = {
+        "HIGH": 0.90,     # Excellent budget state
+        "MEDIUM": 0.75,   # Good budget state
+        "LOW": 0.55,      # Constrained budget state
+        "CRITICAL": 0.30  # Severely limited budget state
+    }
     
     @staticmethod
+    @functools.lru_cache(maxsize=128)
     def compute_budget_state(weekly_spending, weekly_budget):
         """
         Fine-grained continuous state representation
@@ -847,15 +1191,10 @@ class MDPOptimizer:
         # Continuous budget ratio
         ratio = weekly_spending / weekly_budget
         
-        # Discrete state for policy
-        if ratio >= 0.85:
-            state = "CRITICAL"
-        elif ratio >= 0.65:
-            state = "LOW"
-        elif ratio >= 0.35:
-            state = "MEDIUM"
-        else:
-            state = "HIGH"
+        # Discrete state for policy (one C-level bisect over the thresholds)
+        state = MDPOptimizer.BUDGET_STATES[
+            bisect.bisect_right(MDPOptimizer.BUDGET_STATE_THRESHOLDS, ratio)
+        ]
         
         # Continuous value [0, 1] for value function approximation
         continuous_state = max(0.0, min(1.0, ratio))
@@ -900,6 +1239,7 @@ class MDPOptimizer:
         return transitions, next_ratio
     
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def utility_function(drink_price, budget_ratio, risk_aversion=0.5):
         """
         Enhanced risk-aware utility function using:
@@ -955,6 +1295,49 @@ class MDPOptimizer:
 
         return normalized_utility
     
+    @staticmethod
+    def utility_function_vec(drink_prices, budget_ratios, risk_aversion=0.5):
+        """
+        utility_function() over arrays: drink_prices and budget_ratios
+        broadcast against each other (e.g. a row of prices against a column
+        of ratios gives the whole reward grid in one pass).
+        """
+        drink_prices = np.asarray(drink_prices, dtype=np.float64)
+        budget_ratios = np.asarray(budget_ratios, dtype=np.float64)
+
+        # CRRA utility for satisfaction
+        rho = 0.5 + risk_aversion * 1.5
+        if rho != 1.0:
+            base_satisfaction = (drink_prices + 1) ** (1 - rho) / (1 - rho)
+        else:
+            base_satisfaction = np.log(drink_prices + 1)
+
+        # Prospect theory: loss aversion above the 50% reference point, gain
+        # below it (each side clipped at 0 so neither branch sees a negative base)
+        reference_point = 0.5
+        budget_penalty = np.where(
+            budget_ratios > reference_point,
+            2.25 * np.maximum(budget_ratios - reference_point, 0.0) ** 0.88,
+            -(np.maximum(reference_point - budget_ratios, 0.0) ** 0.88)
+        )
+
+        # Severe penalty for budget overrun
+        budget_penalty = budget_penalty + np.where(
+            budget_ratios > 1.0, 5.0 * (budget_ratios - 1.0), 0.0
+        )
+
+        # Value proposition and quality bonuses
+        avg_price = 5.5
+        value_bonus = np.log(avg_price / (drink_prices + 0.1) + 1) * 0.3
+        quality_bonus = np.minimum(0.2, drink_prices / 20.0)
+
+        utility = (base_satisfaction * 0.4 +
+                   value_bonus * 0.3 +
+                   quality_bonus * 0.1 -
+                   budget_penalty * risk_aversion * 0.8)
+
+        return 1.0 / (1.0 + np.exp(-utility * 0.5))
+
     @staticmethod
     def policy_iteration(budget_ratio, weekly_budget, drink_prices, risk_aversion=0.5):
         """
@@ -969,84 +1352,74 @@ class MDPOptimizer:
         num_states = 25
         num_actions = min(len(drink_prices), 10)
 
-        # Initialize random policy (action index for each state)
-        policy = [0] * num_states
-        state_values = [0.0] * num_states
+        # Sort prices for consistent action indexing (only the cheapest
+        # num_actions are used, so select those rather than sort them all)
+        sorted_prices = sorted(heapq.nsmallest(num_actions, drink_prices))
+
+        # Rewards and transitions don't depend on the policy: build them once
+        rewards, transitions = MDPOptimizer._mdp_tensors(
+            num_states, sorted_prices, weekly_budget, risk_aversion
+        )
+        states = np.arange(num_states)
 
-        # Sort prices for consistent action indexing
-        sorted_prices = sorted(drink_prices)[:num_actions]
+        # Initialize random policy (action index for each state)
+        policy = np.zeros(num_states, dtype=np.intp)
+        state_values = np.zeros(num_states)
 
         for iteration in range(MDPOptimizer.MAX_ITERATIONS):
             # Policy Evaluation: Compute V^π using current policy
+            policy_rewards = rewards[states, policy]
+            policy_transitions = transitions[states, policy]
             for _ in range(20):  # Inner iteration for evaluation
-                new_values = [0.0] * num_states
-
-                for state_idx in range(num_states):
-                    current_ratio = state_idx / num_states
-                    action_idx = policy[state_idx]
-                    price = sorted_prices[min(action_idx, len(sorted_prices) - 1)]
-
-                    # Immediate reward
-                    reward = MDPOptimizer.utility_function(price, current_ratio, risk_aversion)
-
-                    # Expected future value under policy
-                    transitions, next_ratio = MDPOptimizer.transition_dynamics(
-                        current_ratio, price, weekly_budget
-                    )
-
-                    future_value = 0.0
-                    for next_state_name, prob in transitions.items():
-                        # Map state name to continuous ratio
-                        state_map = {"HIGH": 0.2, "MEDIUM": 0.5, "LOW": 0.75, "CRITICAL": 0.95}
-                        next_ratio_est = state_map.get(next_state_name, 0.5)
-                        next_state_idx = min(num_states - 1, int(next_ratio_est * num_states))
-                        future_value += prob * state_values[next_state_idx]
-
-                    new_values[state_idx] = reward + MDPOptimizer.GAMMA * future_value
-
-                state_values = new_values
-
-            # Policy Improvement: Update policy to be greedy
-            policy_stable = True
-
-            for state_idx in range(num_states):
-                current_ratio = state_idx / num_states
-                old_action = policy[state_idx]
-
-                # Find best action for this state
-                best_action = old_action
-                best_value = -float('inf')
-
-                for action_idx, price in enumerate(sorted_prices):
-                    reward = MDPOptimizer.utility_function(price, current_ratio, risk_aversion)
-
-                    transitions, _ = MDPOptimizer.transition_dynamics(
-                        current_ratio, price, weekly_budget
-                    )
-
-                    future_value = 0.0
-                    for next_state_name, prob in transitions.items():
-                        state_map = {"HIGH": 0.2, "MEDIUM": 0.5, "LOW": 0.75, "CRITICAL": 0.95}
-                        next_ratio_est = state_map.get(next_state_name, 0.5)
-                        next_state_idx = min(num_states - 1, int(next_ratio_est * num_states))
-                        future_value += prob * state_values[next_state_idx]
-
-                    action_value = reward + MDPOptimizer.GAMMA * future_value
-
-                    if action_value > best_value:
-                        best_value = action_value
-                        best_action = action_idx
-
-                policy[state_idx] = best_action
+                state_values = policy_rewards + MDPOptimizer.GAMMA * (
+                    policy_transitions @ state_values
+                )
 
-                if old_action != best_action:
-                    policy_stable = False
+            # Policy Improvement: Update policy to be greedy (first best
+            # action on ties). When rewards saturate (risk_aversion near 1/3)
+            # several actions agree to within rounding, and which of them
+            # comes out best depends on the summation order of the matmul.
+            action_values = rewards + MDPOptimizer.GAMMA * (transitions @ state_values)
+            new_policy = action_values.argmax(axis=1)
 
             # Check for convergence
+            policy_stable = np.array_equal(new_policy, policy)
+            policy = new_policy
             if policy_stable:
                 break
 
-        return policy, state_values
+        return policy.tolist(), state_values.tolist()
+
+    @staticmethod
+    def _mdp_tensors(num_states, drink_prices, weekly_budget, risk_aversion):
+        """
+        Reward matrix R[s, a] and transition tensor P[s, a, s'] over the
+        discretised budget ratios s / num_states, with each next budget state
+        mapped to the ratio index it stands for.
+        """
+        state_map = MDPOptimizer.NEXT_STATE_RATIO
+        num_actions = len(drink_prices)
+
+        # Every (ratio, price) reward in one broadcast
+        rewards = MDPOptimizer.utility_function_vec(
+            np.asarray(drink_prices, dtype=np.float64)[None, :],
+            (np.arange(num_states) / num_states)[:, None],
+            risk_aversion
+        )
+        transitions = np.zeros((num_states, num_actions, num_states))
+
+        for state_idx in range(num_states):
+            current_ratio = state_idx / num_states
+            for action_idx, price in enumerate(drink_prices):
+                next_states, _ = MDPOptimizer.transition_dynamics(
+                    current_ratio, price, weekly_budget
+                )
+                for next_state_name, prob in next_states.items():
+                    next_state_idx = min(num_states - 1,
+                                         int(state_map[next_state_name] * num_states))
+                    transitions[state_idx, action_idx, next_state_idx] += prob
+
+        return rewards, transitions
 
     @staticmethod
     def value_iteration(budget_ratio, weekly_budget, drink_prices, risk_aversion=0.5):
@@ -1059,43 +1432,23 @@ class MDPOptimizer:
         """
         # Finer discretization for better approximation
         num_states = 30
-        state_values = [0.0] * num_states
-
-        for iteration in range(MDPOptimizer.MAX_ITERATIONS):
-            new_values = [0.0] * num_states
-            max_change = 0.0
-
-            for i in range(num_states):
-                current_ratio = i / num_states
+        if not drink_prices:
+            return [0.0] * num_states
 
-                # Evaluate all possible actions (drink prices)
-                action_values = []
+        # Equal prices are the same action; only the max over actions is kept
+        drink_prices = list(dict.fromkeys(drink_prices))
 
-                for price in drink_prices:
-                    # Immediate reward with risk awareness
-                    reward = MDPOptimizer.utility_function(price, current_ratio, risk_aversion)
-
-                    # Expected future value with stochastic transitions
-                    transitions, next_ratio = MDPOptimizer.transition_dynamics(
-                        current_ratio, price, weekly_budget
-                    )
-
-                    # Calculate expected value over all next states
-                    expected_future_value = 0.0
-                    for next_state_name, prob in transitions.items():
-                        # Map discrete state to continuous ratio for lookup
-                        state_map = {"HIGH": 0.2, "MEDIUM": 0.5, "LOW": 0.75, "CRITICAL": 0.95}
-                        next_ratio_est = state_map.get(next_state_name, next_ratio)
-                        next_state_idx = min(num_states - 1, int(next_ratio_est * num_states))
-                        expected_future_value += prob * state_values[next_state_idx]
-
-                    # Q-value for this action
-                    q_value = reward + MDPOptimizer.GAMMA * expected_future_value
-                    action_values.append(q_value)
+        # Rewards and transitions don't depend on V: build them once
+        rewards, transitions = MDPOptimizer._mdp_tensors(
+            num_states, drink_prices, weekly_budget, risk_aversion
+        )
+        state_values = np.zeros(num_states)
 
-                # Bellman optimality: V(s) = max_a Q(s,a)
-                new_values[i] = max(action_values) if action_values else 0.0
-                max_change = max(max_change, abs(new_values[i] - state_values[i]))
+        for iteration in range(MDPOptimizer.MAX_ITERATIONS):
+            # Bellman optimality: V(s) = max_a Q(s,a)
+            q_values = rewards + MDPOptimizer.GAMMA * (transitions @ state_values)
+            new_values = q_values.max(axis=1)
+            max_change = np.abs(new_values - state_values).max()
 
             state_values = new_values
 
@@ -1103,7 +1456,7 @@ class MDPOptimizer:
             if max_change < MDPOptimizer.EPSILON:
                 break
 
-        return state_values
+        return state_values.tolist()
     
     @staticmethod
     def ucb1_exploration_bonus(drink_price, total_selections, drink_selections):
@@ -1125,9 +1478,28 @@ class MDPOptimizer:
 
         return exploration_bonus
 
+    @staticmethod
+    def option_values(weekly_budget, available_prices):
+        """
+        Option value of each next budget state for q_learning_score(): the
+        share of available_prices still affordable in that state, capped at
+        0.15. Depends only on the budget and the price list, so one call can
+        serve every drink scored against them.
+        """
+        values = {}
+        for state, next_state_ratio in MDPOptimizer.NEXT_STATE_RATIO.items():
+            if available_prices:
+                affordable_count = sum(1 for p in available_prices
+                                      if p <= weekly_budget * (1 - next_state_ratio))
+                values[state] = min(0.15, affordable_count / len(available_prices) * 0.15)
+            else:
+                values[state] = 0.0
+
+        return values
+
     @staticmethod
     def q_learning_score(drink_price, budget_state, budget_ratio, weekly_budget,
-                        available_prices, risk_aversion=0.5):
+                        available_prices, risk_aversion=0.5, option_values=None):
         """
         Enhanced Q-learning with:
         - Multi-step lookahead (n-step returns)
@@ -1138,7 +1510,13 @@ class MDPOptimizer:
 
         This gives the expected cumulative reward of taking action 'a'
         (buying a drink at price) in state 's' (budget state)
+
+        ``option_values`` is an optional precomputed option_values(weekly_budget,
+        available_prices).
         """
+        if option_values is None:
+            option_values = MDPOptimizer.option_values(weekly_budget, available_prices)
+
         # Immediate reward with risk-awareness
         immediate_reward = MDPOptimizer.utility_function(drink_price, budget_ratio, risk_aversion)
 
@@ -1147,50 +1525,34 @@ class MDPOptimizer:
             budget_ratio, drink_price, weekly_budget
         )
 
-        # Multi-step lookahead (2-step return for better long-term planning)
-        n_steps = 2
-        future_value = 0.0
-
-        for step in range(n_steps):
-            step_discount = MDPOptimizer.GAMMA ** step
-            step_value = 0.0
-
-            for next_state, prob in transitions.items():
-                # Enhanced state value estimation using value function approximation
-                state_values = {
-                    "HIGH": 0.90,     # Excellent budget state
-                    "MEDIUM": 0.75,   # Good budget state
-                    "LOW": 0.55,      # Constrained budget state
-                    "CRITICAL": 0.30  # Severely limited budget state
-                }
-
-                base_value = state_values.get(next_state, 0.5)
-
-                # Adjust based on available actions in next state
-                # More budget remaining = more valuable options
-                next_ratio_map = {
-                    "HIGH": 0.2, "MEDIUM": 0.5,
-                    "LOW": 0.75, "CRITICAL": 0.95
-                }
-                next_state_ratio = next_ratio_map.get(next_state, 0.5)
-
-                # Value of flexibility (having budget remaining)
-                flexibility_value = (1.0 - next_state_ratio) * 0.2
-
-                # Option value (ability to choose from more drinks)
-                if available_prices:
-                    affordable_count = sum(1 for p in available_prices
-                                          if p <= weekly_budget * (1 - next_state_ratio))
-                    option_value = min(0.15, affordable_count / len(available_prices) * 0.15)
-                else:
-                    option_value = 0.0
+        # Multi-step lookahead (2-step return for better long-term planning).
+        # Both steps see the same transitions, so the expected next-state
+        # value is computed once and discounted per step.
+        state_values = MDPOptimizer.NEXT_STATE_VALUE
+        next_ratio_map = MDPOptimizer.NEXT_STATE_RATIO
+
+        step_value = 0.0
+        for next_state, prob in transitions.items():
+            # Enhanced state value estimation using value function approximation
+            base_value = state_values.get(next_state, 0.5)
 
-                # Combined state value
-                enhanced_state_value = base_value + flexibility_value + option_value
+            # Adjust based on available actions in next state
+            # More budget remaining = more valuable options
+            next_state_ratio = next_ratio_map.get(next_state, 0.5)
 
-                step_value += prob * enhanced_state_value
+            # Value of flexibility (having budget remaining)
+            flexibility_value = (1.0 - next_state_ratio) * 0.2
 
-            future_value += step_discount * step_value
+            # Option value (ability to choose from more drinks)
+            option_value = option_values[next_state]
+
+            # Combined state value
+            enhanced_state_value = base_value + flexibility_value + option_value
+
+            step_value += prob * enhanced_state_value
+
+        # Steps 0 and 1, discounted by GAMMA ** step
+        future_value = step_value + MDPOptimizer.GAMMA * step_value
 
         # Q-value: immediate + discounted multi-step future
         q_value = immediate_reward + future_value
@@ -1199,7 +1561,7 @@ class MDPOptimizer:
     
     @staticmethod
     def mdp_score(drink_price, budget_state, weekly_budget, available_prices=None,
-                  risk_aversion=0.5, use_policy_iteration=False):
+                  risk_aversion=0.5, use_policy_iteration=False, option_values=None):
         """
         Enhanced MDP scoring using:
         - Q-learning with multi-step returns
@@ -1207,15 +1569,13 @@ class MDPOptimizer:
         - Value iteration for state value estimation
         - UCB1 exploration bonus
 
+        ``option_values`` is passed through to q_learning_score().
+
         Returns: Optimal action-value for purchasing this drink
         """
         # Get continuous state representation
         if weekly_budget > 0:
-            state_spending_map = {
-                "CRITICAL": 0.90, "LOW": 0.75,
-                "MEDIUM": 0.50, "HIGH": 0.25
-            }
-            weekly_spending = state_spending_map.get(budget_state, 0.5) * weekly_budget
+            weekly_spending = MDPOptimizer.STATE_SPENDING_RATIO.get(budget_state, 0.5) * weekly_budget
             budget_ratio = weekly_spending / weekly_budget
         else:
             budget_ratio = 0.5
@@ -1244,7 +1604,7 @@ class MDPOptimizer:
         else:
             q_score = MDPOptimizer.q_learning_score(
                 drink_price, budget_state, budget_ratio,
-                weekly_budget, available_prices, risk_aversion
+                weekly_budget, available_prices, risk_aversion, option_values
             )
 
         return q_score
@@ -1252,41 +1612,59 @@ class MDPOptimizer:
 # -------------------------------------------------------------
 # 4. MAIN RECOMMENDATION PIPELINE (Enhanced)
 # -------------------------------------------------------------
-def recommend(user_id, mood, budget):
+def recommend(user_id, mood, budget, conn=None, history=None):
     """
     Advanced recommendation system combining:
     - CSP for constraint-based filtering
     - Bayesian inference for preference learning
     - MDP for budget-aware optimization
+
+    Inside the backend process pass the request's database connection as
+    ``conn`` to read history and spending directly instead of over HTTP.
+    ``history`` is the user's services.purchase_history() list when the
+    caller has already loaded it (see recommend_batch()).
     """
-    print(f"\n{'='*60}")
-    print(f"RECOMMENDATION REQUEST: User {user_id}, Mood: {mood}, Budget: ${budget}")
-    print(f"{'='*60}\n")
+    log.info("RECOMMENDATION REQUEST: User %s, Mood: %s, Budget: $%s", user_id, mood, budget)
     
+    if history is not None:
+        load_history = lambda: {"history": history}
+
+    if conn is None:
+        # Fire the history, weekly-spending and candidate requests together
+        if history is None:
+            load_history = _HTTP_EXECUTOR.submit(_get_json, HISTORY_URL % user_id).result
+        load_spending = _HTTP_EXECUTOR.submit(_get_json, SPENDING_URL % user_id).result
+        load_candidates = _HTTP_EXECUTOR.submit(CSPFilter.fetch_candidates, mood, budget).result
+    else:
+        # Same data the endpoints would serve, without the loopback round trips
+        if history is None:
+            load_history = lambda: {"history": services.purchase_history(conn, user_id)}
+        load_spending = lambda: services.weekly_spending(conn, user_id)
+        load_candidates = lambda: CSPFilter.fetch_candidates(mood, budget)
+
     # ---------------------------------------------------------
     # A) GET PURCHASE HISTORY WITH TEMPORAL DATA
     # ---------------------------------------------------------
     try:
-        hist_url = f"{BACKEND_URL}/api/purchase/history/{user_id}"
-        history_response = requests.get(hist_url).json()
+        history_response = load_history()
         history_list = history_response.get("history", []) if isinstance(history_response, dict) else []
         
-        # Enhance history with days_ago calculation
-        from datetime import datetime
+        # Enhance history with days_ago calculation (one clock read for all)
+        now = datetime.now()
         for item in history_list:
             if 'purchase_date' in item:
                 try:
                     purchase_date = datetime.strptime(item['purchase_date'], '%Y-%m-%d %H:%M:%S')
-                    days_ago = (datetime.now() - purchase_date).days
+                    days_ago = (now - purchase_date).days
                     item['days_ago'] = days_ago
                 except:
                     item['days_ago'] = 30  # Default if parsing fails
             else:
                 item['days_ago'] = 30
         
-        print(f"✓ Loaded {len(history_list)} purchase records")
+        log.info("✓ Loaded %d purchase records", len(history_list))
     except Exception as e:
-        print(f"✗ ERROR fetching history: {e}")
+        log.error("✗ ERROR fetching history: %s", e)
         history_list = []
 
     # Extract recent purchases for diversity constraint
@@ -1299,8 +1677,7 @@ def recommend(user_id, mood, budget):
     # B) GET WEEKLY SPENDING AND BUDGET
     # ---------------------------------------------------------
     try:
-        spend_url = f"{BACKEND_URL}/api/purchase/weekly-spending/{user_id}"
-        weekly_data = requests.get(spend_url).json()
+        weekly_data = load_spending()
         
         if isinstance(weekly_data, dict):
             weekly_spending = weekly_data.get("spent_this_week", 0)
@@ -1308,15 +1685,20 @@ def recommend(user_id, mood, budget):
         else:
             weekly_spending = 0
             weekly_budget = 50.0
-            
-        print(f"✓ Weekly: ${weekly_spending:.2f} / ${weekly_budget:.2f}")
+
+        # Anything but numbers falls back to the defaults below
+        if not (isinstance(weekly_spending, (int, float)) and
+                isinstance(weekly_budget, (int, float))):
+            raise TypeError(f"non-numeric spending {weekly_spending!r} / {weekly_budget!r}")
+
+        log.info("✓ Weekly: $%.2f / $%.2f", weekly_spending, weekly_budget)
     except Exception as e:
-        print(f"✗ ERROR fetching spending: {e}")
+        log.error("✗ ERROR fetching spending: %s", e)
         weekly_spending = 0
         weekly_budget = 50.0
 
     budget_state = MDPOptimizer.compute_budget_state(weekly_spending, weekly_budget)
-    print(f"✓ Budget State: {budget_state}")
+    log.info("✓ Budget State: %s", budget_state)
 
     # ---------------------------------------------------------
     # C) CSP FILTERING (Advanced Constraint Satisfaction)
@@ -1325,21 +1707,22 @@ def recommend(user_id, mood, budget):
     drinks = csp_filter.filter_beverages(
         mood=mood,
         budget=budget,
-        exclude_recent=recent_drinks if len(recent_drinks) > 0 else None
+        exclude_recent=recent_drinks if len(recent_drinks) > 0 else None,
+        candidates=load_candidates()
     )
-    print(f"✓ CSP Filter: {len(drinks)} candidates")
+    log.info("✓ CSP Filter: %d candidates", len(drinks))
 
     # ------------------ FALLBACK ----------------------------
     if not drinks:
-        print("⚠ No drinks from CSP, using fallback")
-        conn = sqlite3.connect('starbucks_budget.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        query = "SELECT * FROM beverages WHERE price <= ?"
-        c.execute(query, (float(budget),))
-        rows = c.fetchall()
-        drinks = [{"name": r["name"], "price": r["price"], "category": "Coffee"} for r in rows[:10]]
-        conn.close()
+        log.warning("⚠ No drinks from CSP, using fallback")
+        # Only the columns we use, and let SQLite stop after the first ten
+        # affordable rows (catalog order, as the old rows[:10] slice took)
+        query = ("SELECT name, price FROM beverages WHERE price <= ? "
+                 "ORDER BY id LIMIT 10")
+        # The caller's connection when there is one, whatever its row factory
+        db = conn if conn is not None else _fallback_db()
+        rows = db.execute(query, (float(budget),)).fetchall()
+        drinks = [{"name": name, "price": price, "category": "Coffee"} for name, price in rows]
 
     if not drinks:
         return []
@@ -1347,7 +1730,12 @@ def recommend(user_id, mood, budget):
     # ---------------------------------------------------------
     # D) GET ALL DRINK NAMES FOR BAYESIAN PRIORS
     # ---------------------------------------------------------
-    all_drink_names = list(set(d["name"] for d in drinks))
+    # Read each candidate's fields once; scoring below works from these lists
+    names = [d["name"] for d in drinks]
+    all_prices = [float(d["price"]) for d in drinks]
+    categories = [d.get("category", "Other") for d in drinks]
+
+    all_drink_names = list(dict.fromkeys(names))
 
     # ---------------------------------------------------------
     # E) SCORE EACH DRINK (State-of-the-Art Ensemble Algorithm)
@@ -1356,69 +1744,95 @@ def recommend(user_id, mood, budget):
     bayesian = BayesianPredictor(alpha_prior=1.5)
     mdp = MDPOptimizer()
     
-    # Extract all prices for MDP value iteration
-    all_prices = [float(d["price"]) for d in drinks]
-
-    print(f"\n{'='*80}")
-    print(f"SCORING {len(drinks)} DRINKS WITH ADVANCED ALGORITHMS")
-    print(f"{'='*80}")
-    print(f"{'Drink':<35} {'Price':>7} {'Bayes':>8} {'MDP':>8} {'CSP':>7} {'Final':>8}")
-    print("-" * 80)
-
-    for drink in drinks:
-        name = drink["name"]
-        price = float(drink["price"])
-        
+    # How many drinks stay affordable in each next budget state is the same
+    # for every drink
+    option_values = mdp.option_values(weekly_budget, all_prices)
+
+    # Ensemble weights depend only on how much history we have, so they are
+    # the same for every drink; work them out once instead of per iteration.
+    history_confidence = min(0.75, 0.35 + len(history_list) * 0.02)
+    bayesian_weight = history_confidence * 0.50
+    mdp_weight = 0.35
+    csp_weight = (1.0 - history_confidence) * 0.15
+    total_weight = bayesian_weight + mdp_weight + csp_weight
+    bayesian_weight /= total_weight
+    mdp_weight /= total_weight
+    csp_weight /= total_weight
+
+    # Slight randomness for exploration (epsilon-greedy)
+    exploration_factor = 0.02
+
+    # Categories of the first three scored drinks (the diversity reference set)
+    leading_categories = []
+
+    b_scores = []
+    m_scores = []
+    csp_scores = []
+    # The Bayesian model only reads a drink's name, price and category, so a
+    # drink listed more than once is scored once; the MDP score depends on
+    # the price alone, and catalog prices repeat
+    b_by_drink = {}
+    m_by_price = {}
+
+    for drink, name, price, category in zip(drinks, names, all_prices, categories):
         # 1. BAYESIAN SCORE (Enhanced hierarchical Bayesian with Thompson sampling)
-        b_score = bayesian.bayesian_score(
-            name, drink, history_list, all_drink_names, mood, current_context=None
-        )
+        drink_key = (name, price, category)
+        b_score = b_by_drink.get(drink_key)
+        if b_score is None:
+            b_score = b_by_drink[drink_key] = bayesian.bayesian_score(
+                name, drink, history_list, all_drink_names, mood, current_context=None
+            )
+        b_scores.append(b_score)
 
         # 2. MDP SCORE (Enhanced Q-learning with multi-step returns and policy iteration)
-        m_score = mdp.mdp_score(
-            price, budget_state, weekly_budget, all_prices,
-            risk_aversion=0.5, use_policy_iteration=False
-        )
+        m_score = m_by_price.get(price)
+        if m_score is None:
+            m_score = m_by_price[price] = mdp.mdp_score(
+                price, budget_state, weekly_budget, all_prices,
+                risk_aversion=0.5, use_policy_iteration=False, option_values=option_values
+            )
+        m_scores.append(m_score)
         
         # 3. CSP SCORE (constraint satisfaction quality)
         # Higher score for drinks that satisfy more soft constraints
         csp_score = 1.0
         
         # Bonus for category diversity
-        if drink.get("category") not in [r.get("category") for r in results[:3]]:
+        if category not in leading_categories:
             csp_score += 0.2
+        if len(leading_categories) < 3:
+            leading_categories.append(category)
         
         # Bonus for not being recently purchased
         if recent_drinks and name not in recent_drinks:
             csp_score += 0.15
         
         # Normalize CSP score
-        csp_score = min(1.0, csp_score)
-        
-        # 4. ENSEMBLE COMBINATION (Adaptive weighting)
-        # Weight based on data availability and confidence
-        history_confidence = min(0.75, 0.35 + len(history_list) * 0.02)
-        
-        # Weights that adapt based on context
-        bayesian_weight = history_confidence * 0.50
-        mdp_weight = 0.35
-        csp_weight = (1.0 - history_confidence) * 0.15
-        
-        # Normalize weights
-        total_weight = bayesian_weight + mdp_weight + csp_weight
-        bayesian_weight /= total_weight
-        mdp_weight /= total_weight
-        csp_weight /= total_weight
-        
-        # Final ensemble score
-        final_score = (bayesian_weight * b_score + 
-                      mdp_weight * m_score + 
-                      csp_weight * csp_score)
-        
-        # Add slight randomness for exploration (epsilon-greedy)
-        exploration_factor = 0.02
-        final_score += exploration_factor * (hash(name) % 100) / 1000.0
-
+        csp_scores.append(min(1.0, csp_score))
+
+    # 4. ENSEMBLE COMBINATION (Adaptive weighting), one array pass for all drinks
+    # Exploration noise in [0, 0.1) per drink, drawn in one batch from a
+    # generator seeded by the user so their rankings are reproducible; draws
+    # go to drinks in name order, so a drink's noise doesn't depend on the
+    # order the candidates arrived in
+    exploration = np.empty(len(drinks))
+    exploration[sorted(range(len(drinks)), key=names.__getitem__)] = (
+        np.random.default_rng(user_id).uniform(0.0, 0.1, len(drinks))
+    )
+    final_scores = (bayesian_weight * np.asarray(b_scores, dtype=np.float64) +
+                    mdp_weight * np.asarray(m_scores, dtype=np.float64) +
+                    csp_weight * np.asarray(csp_scores, dtype=np.float64))
+    final_scores += exploration_factor * exploration
+
+    # The per-drink score table is debug output; skip formatting it otherwise
+    debug_scores = log.isEnabledFor(logging.DEBUG)
+    if debug_scores:
+        log.debug("SCORING %d DRINKS WITH ADVANCED ALGORITHMS", len(drinks))
+        log.debug("%-35s %7s %8s %8s %7s %8s", "Drink", "Price", "Bayes", "MDP", "CSP", "Final")
+
+    for drink, name, price, category, b_score, m_score, csp_score, final_score in zip(
+            drinks, names, all_prices, categories,
+            b_scores, m_scores, csp_scores, final_scores.tolist()):
         results.append({
             "name": name,
             "price": price,
@@ -1426,92 +1840,139 @@ def recommend(user_id, mood, budget):
             "bayesian_score": round(b_score, 5),
             "mdp_score": round(m_score, 5),
             "csp_score": round(csp_score, 3),
-            "category": drink.get("category", "Other"),
+            "category": category,
             "id": drink.get("id", 1)
         })
-        
-        print(f"{name:<35} ${price:>6.2f} {b_score:>8.5f} {m_score:>8.5f} {csp_score:>7.3f} {final_score:>8.5f}")
+
+        if debug_scores:
+            log.debug("%-35s $%6.2f %8.5f %8.5f %7.3f %8.5f",
+                      name, price, b_score, m_score, csp_score, final_score)
 
     # ---------------------------------------------------------
     # F) ADVANCED DIVERSIFICATION (Maximal Marginal Relevance)
     # ---------------------------------------------------------
-    # Sort by score initially
-    results.sort(key=lambda x: x["score"], reverse=True)
-    
     # Maximal Marginal Relevance (MMR) for diversity
     # MMR = λ * Relevance - (1-λ) * Similarity to already selected items
+    # Pairwise similarities are computed once as a matrix; each round is then
+    # an argmax over the drinks not yet picked, ties going to the higher-scored
+    # drink and then to the earlier one.
     top_results = []
     lambda_param = 0.7  # Balance between relevance and diversity
     
     if results:
+        # Relevance (original score)
+        relevance = np.array([r["score"] for r in results])
+
+        # Similarity between drinks (based on price and category)
+        prices = np.array([r["price"] for r in results])
+        category_ids = {}
+        categories = np.array([category_ids.setdefault(r["category"], len(category_ids))
+                               for r in results])
+        # Price similarity (normalized) and category similarity (binary)
+        price_sim = np.maximum(0, 1.0 - np.abs(prices[:, None] - prices[None, :]) / 10.0)
+        category_sim = categories[:, None] == categories[None, :]
+        # Combined similarity
+        similarity = 0.4 * price_sim + 0.6 * category_sim
+
+        available = np.ones(len(results), dtype=bool)
+        max_similarity = np.zeros(len(results))  # to the drinks picked so far
+
         # Always pick the best scored item first
-        top_results.append(results[0])
+        best = int(np.argmax(relevance))
         
-        # Select remaining items using MMR
-        for _ in range(min(2, len(results) - 1)):
-            best_mmr_score = -float('inf')
-            best_item = None
-            
-            for drink in results:
-                if drink in top_results:
-                    continue
-                
-                # Relevance (original score)
-                relevance = drink["score"]
-                
-                # Similarity to selected items (based on price and category)
-                max_similarity = 0.0
-                for selected in top_results:
-                    # Price similarity (normalized)
-                    price_diff = abs(drink["price"] - selected["price"]) / 10.0
-                    price_sim = max(0, 1.0 - price_diff)
-                    
-                    # Category similarity (binary)
-                    category_sim = 1.0 if drink["category"] == selected["category"] else 0.0
-                    
-                    # Combined similarity
-                    similarity = 0.4 * price_sim + 0.6 * category_sim
-                    max_similarity = max(max_similarity, similarity)
-                
-                # MMR score
-                mmr_score = lambda_param * relevance - (1 - lambda_param) * max_similarity
-                
-                if mmr_score > best_mmr_score:
-                    best_mmr_score = mmr_score
-                    best_item = drink
-            
-            if best_item:
-                top_results.append(best_item)
+        # Then select remaining items using MMR
+        for mmr_rounds_left in range(min(2, len(results) - 1), -1, -1):
+            top_results.append(results[best])
+            # Listings identical to the pick count as picked too
+            for i in np.flatnonzero(available).tolist():
+                if results[i] == results[best]:
+                    available[i] = False
+            np.maximum(max_similarity, similarity[:, best], out=max_similarity)
+
+            if not mmr_rounds_left or not available.any():
+                break
+
+            # MMR score
+            mmr_scores = lambda_param * relevance - (1 - lambda_param) * max_similarity
+            best_mmr_score = mmr_scores[available].max()
+            tied = np.flatnonzero(available & (mmr_scores == best_mmr_score))
+            best = int(tied[np.argmax(relevance[tied])])
     
-    print(f"\n{'='*80}")
-    print(f"TOP 3 RECOMMENDATIONS (WITH MAXIMAL MARGINAL RELEVANCE):")
-    print(f"{'='*80}")
-    for i, drink in enumerate(top_results[:3], 1):
-        print(f"{i}. {drink['name']:<35} ${drink['price']:>6.2f}")
-        print(f"   Category: {drink['category']:<15} Overall Score: {drink['score']:.5f}")
-        print(f"   Breakdown → Bayesian: {drink['bayesian_score']:.5f} | "
-              f"MDP: {drink['mdp_score']:.5f} | CSP: {drink['csp_score']:.3f}")
-        print("-" * 80)
-    print(f"{'='*80}\n")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("TOP 3 RECOMMENDATIONS (WITH MAXIMAL MARGINAL RELEVANCE):")
+        for i, drink in enumerate(top_results[:3], 1):
+            log.debug("%d. %-35s $%6.2f", i, drink['name'], drink['price'])
+            log.debug("   Category: %-15s Overall Score: %.5f", drink['category'], drink['score'])
+            log.debug("   Breakdown → Bayesian: %.5f | MDP: %.5f | CSP: %.3f",
+                      drink['bayesian_score'], drink['mdp_score'], drink['csp_score'])
     
     return top_results[:3]
 
 
+def recommend_batch(batch, conn=None, return_exceptions=False):
+    """
+    recommend() for a list of {'user_id', 'mood', 'budget'} requests, in order.
+
+    Every user's purchase history is read with one query up front and each
+    request is then scored in-process. Priors stay per request: they are
+    built from that user's own purchase counts.
+
+    With ``return_exceptions`` a request that raises gets its exception in
+    its slot instead of aborting the rest of the batch.
+    """
+    if conn is None:
+        conn = _fallback_db()
+    try:
+        histories = services.purchase_histories(conn, [r['user_id'] for r in batch])
+    except sqlite3.Error as e:
+        # Each recommend() then reads (and handles) its own history
+        log.error("✗ ERROR fetching batch history: %s", e)
+        histories = {}
+
+    results = []
+    for r in batch:
+        try:
+            results.append(recommend(r['user_id'], r['mood'], r['budget'],
+                                     conn=conn, history=histories.get(r['user_id'])))
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
 # Legacy compatibility functions
-def bayesian_score(drink_name, history_counts):
-    """Legacy function for backward compatibility"""
-    total = sum(history_counts.values()) + len(history_counts)
+def bayesian_score(drink_name, history_counts, total=None):
+    """Legacy function for backward compatibility
+
+    Pass ``total`` (sum of counts + number of drinks) when scoring several
+    drinks against the same counts so it is summed only once.
+    """
+    if total is None:
+        total = sum(history_counts.values()) + len(history_counts)
     count = history_counts.get(drink_name, 0) + 1
     return count / (total or 1)
 
+def _price_sensitive_score(drink_price):
+    return 1 / (drink_price + 1)
+
+def _price_tolerant_score(drink_price):
+    return 1 / math.sqrt(drink_price + 1)
+
+def _price_blind_score(drink_price):
+    return 1.0
+
+# Legacy MDP scoring rule per budget state; anything else scores like HIGH
+_LEGACY_MDP_SCORES = {
+    "CRITICAL": _price_sensitive_score,
+    "LOW": _price_sensitive_score,
+    "MEDIUM": _price_tolerant_score,
+    "HIGH": _price_blind_score,
+}
+
 def mdp_score(drink_price, budget_state):
     """Legacy function for backward compatibility"""
-    if budget_state == "LOW" or budget_state == "CRITICAL":
-        return 1 / (drink_price + 1)
-    elif budget_state == "MEDIUM":
-        return 1 / math.sqrt(drink_price + 1)
-    else:  # HIGH
-        return 1.0
+    return _LEGACY_MDP_SCORES.get(budget_state, _price_blind_score)(drink_price)
 
 def csp_filter(mood, budget):
     """Legacy function for backward compatibility"""
@@ -0,0 +1,120 @@
+"""
+Database reads shared by the Flask routes and the in-process recommender.
+
+Both callers pass in their own sqlite3 connection; the functions return the
+same dicts the corresponding API endpoints serialize.
+"""
+
+import datetime
+
+# Cutoffs are clamped to a century either way: datetime can't go past year 1
+# or 9999, and no purchase history reaches that far
+MAX_HISTORY_DAYS = 36500
+
+
+def _cutoff_date(days):
+    """UTC date `days` ago, as SQLite's date('now', '-N days') would produce."""
+    days = max(-MAX_HISTORY_DAYS, min(days, MAX_HISTORY_DAYS))
+    return (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+def purchase_history(conn, user_id, limit=50, days=365):
+    """The user's purchases from the last `days` days, newest first."""
+    c = conn.cursor()
+    # Plain tuples: every row is copied into a dict anyway
+    c.row_factory = None
+
+    query = '''
+        SELECT p.id, p.mood, p.price, p.purchase_date,
+               b.name as beverage_name, b.category
+        FROM purchases p
+        JOIN beverages b ON p.beverage_id = b.id
+        WHERE p.user_id = ? AND p.purchase_date >= ?
+        ORDER BY p.purchase_date DESC
+        LIMIT ?
+    '''
+
+    cutoff = _cutoff_date(days)
+    c.execute(query, (user_id, cutoff, limit))
+
+    return [{
+        'purchase_id': p[0],
+        'beverage_name': p[4],
+        'category': p[5],
+        'mood': p[1],
+        'price': p[2],
+        'date': p[3]
+    } for p in c.fetchall()]
+
+
+def purchase_histories(conn, user_ids, limit=50, days=365):
+    """purchase_history() for several users at once, read with a single query.
+
+    Returns {user_id: history}; users without purchases map to an empty list.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    histories = {user_id: [] for user_id in user_ids}
+    if not user_ids:
+        return histories
+
+    c = conn.cursor()
+    c.row_factory = None
+
+    placeholders = ','.join('?' * len(user_ids))
+    query = f'''
+        SELECT p.id, p.mood, p.price, p.purchase_date,
+               b.name as beverage_name, b.category, p.user_id
+        FROM purchases p
+        JOIN beverages b ON p.beverage_id = b.id
+        WHERE p.user_id IN ({placeholders}) AND p.purchase_date >= ?
+        ORDER BY p.user_id, p.purchase_date DESC
+    '''
+
+    cutoff = _cutoff_date(days)
+    c.execute(query, (*user_ids, cutoff))
+
+    for p in c.fetchall():
+        history = histories[p[6]]
+        if len(history) < limit:
+            history.append({
+                'purchase_id': p[0],
+                'beverage_name': p[4],
+                'category': p[5],
+                'mood': p[1],
+                'price': p[2],
+                'date': p[3]
+            })
+    return histories
+
+
+def weekly_spending(conn, user_id):
+    """Budget and spending for the current week, or None if there is no such user."""
+    c = conn.cursor()
+    c.row_factory = None
+
+    # Budget and this week's total in one statement
+    query = '''
+        SELECT u.weekly_budget, COALESCE(SUM(p.price), 0) as spent
+        FROM users u
+        LEFT JOIN purchases p
+            ON p.user_id = u.id AND p.purchase_date >= date('now', 'weekday 0', '-7 days')
+        WHERE u.id = ?
+        GROUP BY u.id
+    '''
+    c.execute(query, (user_id,))
+    result = c.fetchone()
+    if not result:
+        return None
+    weekly_budget, spent = result
+
+    today = datetime.date.today()
+    weekday = today.weekday()
+
+    return {
+        'user_id': user_id,
+        'weekly_budget': weekly_budget,
+        'spent_this_week': round(spent, 2),
+        'remaining': round(weekly_budget - spent, 2),
+        'week_start': today - datetime.timedelta(days=weekday),
+        'week_end': today + datetime.timedelta(days=(6 - weekday))
+    }
@@ -8,75 +8,52 @@ Tests the improved algorithms:
 - Bayesian Inference with hierarchical priors and Thompson sampling
 """
 
+import atexit
+import io
 import sqlite3
 import sys
-from recommendation_engine import recommend, MDPOptimizer, CSPFilter, BayesianPredictor
+import traceback
+from contextlib import redirect_stdout
+from functools import lru_cache
+from typing import NamedTuple
+from recommendation_engine import recommend_batch, MDPOptimizer, CSPFilter, BayesianPredictor
+
+
+class Scenario(NamedTuple):
+    """One user/mood/budget case to validate"""
+    user_id: int
+    username: str
+    mood: str
+    budget: float
+    expected_behavior: str
+
 
 # Test scenarios for each user
-TEST_SCENARIOS = [
-    {
-        'user_id': 6,
-        'username': 'budget_conscious_user',
-        'mood': 'Tired',
-        'budget': 5.00,
-        'expected_behavior': 'Should recommend cheap coffee/espresso'
-    },
-    {
-        'user_id': 7,
-        'username': 'splurge_user',
-        'mood': 'Happy',
-        'budget': 15.00,
-        'expected_behavior': 'Should recommend premium frappuccinos/lattes'
-    },
-    {
-        'user_id': 8,
-        'username': 'balanced_user',
-        'mood': 'Focused',
-        'budget': 10.00,
-        'expected_behavior': 'Should recommend mid-range options'
-    },
-    {
-        'user_id': 9,
-        'username': 'coffee_addict',
-        'mood': 'Tired',
-        'budget': 6.00,
-        'expected_behavior': 'Should strongly recommend their usual cheap coffee'
-    },
-    {
-        'user_id': 10,
-        'username': 'mood_driven_user',
-        'mood': 'Stressed',
-        'budget': 8.00,
-        'expected_behavior': 'Should match mood to suitable beverages'
-    },
-    {
-        'user_id': 11,
-        'username': 'variety_seeker',
-        'mood': 'Happy',
-        'budget': 10.00,
-        'expected_behavior': 'Should recommend diverse drinks, possibly new ones'
-    },
-    {
-        'user_id': 12,
-        'username': 'weekend_warrior',
-        'mood': 'Happy',
-        'budget': 12.00,
-        'expected_behavior': 'Should recommend higher-end weekend treats'
-    },
-    {
-        'user_id': 13,
-        'username': 'budget_optimizer',
-        'mood': 'Focused',
-        'budget': 7.00,
-        'expected_behavior': 'Should optimize value/price ratio'
-    }
-]
+TEST_SCENARIOS = (
+    Scenario(6, 'budget_conscious_user', 'Tired', 5.00, 'Should recommend cheap coffee/espresso'),
+    Scenario(7, 'splurge_user', 'Happy', 15.00, 'Should recommend premium frappuccinos/lattes'),
+    Scenario(8, 'balanced_user', 'Focused', 10.00, 'Should recommend mid-range options'),
+    Scenario(9, 'coffee_addict', 'Tired', 6.00, 'Should strongly recommend their usual cheap coffee'),
+    Scenario(10, 'mood_driven_user', 'Stressed', 8.00, 'Should match mood to suitable beverages'),
+    Scenario(11, 'variety_seeker', 'Happy', 10.00, 'Should recommend diverse drinks, possibly new ones'),
+    Scenario(12, 'weekend_warrior', 'Happy', 12.00, 'Should recommend higher-end weekend treats'),
+    Scenario(13, 'budget_optimizer', 'Focused', 7.00, 'Should optimize value/price ratio'),
+)
+
+
+@lru_cache(maxsize=1)
+def get_db_connection():
+    """Database connection shared by the whole run, closed at exit"""
+    conn = sqlite3.connect('starbucks_budget.db')
+    conn.row_factory = sqlite3.Row
+    atexit.register(conn.close)
+    return conn
 
 
+@lru_cache(maxsize=None)
 def get_user_stats(user_id):
-    """Get statistics for a user"""
-    conn = sqlite3.connect('starbucks_budget.db')
-    cursor = conn.cursor()
+    """Get statistics for a user (cached for the run; don't mutate the result)"""
+    cursor = get_db_connection().cursor()
 
     cursor.execute("""
         SELECT
@@ -92,17 +69,7 @@ def get_user_stats(user_id):
     """, (user_id,))
 
     row = cursor.fetchone()
-    conn.close()
-
-    if row:
-        return {
-            'username': row[0],
-            'weekly_budget': row[1],
-            'total_purchases': row[2],
-            'total_spent': row[3],
-            'avg_price': row[4]
-        }
-    return None
+    return dict(row) if row else None
 
 
 def analyze_recommendations(recommendations, scenario, user_stats):
@@ -124,7 +91,7 @@ def analyze_recommendations(recommendations, scenario, user_stats):
     avg_rec_price = sum(prices) / len(prices)
 
     # Test 1: Budget constraint (20 points)
-    if all(p <= scenario['budget'] for p in prices):
+    if all(p <= scenario.budget for p in prices):
         score += 20
         analysis.append("✓ All recommendations within budget")
     else:
@@ -153,7 +120,7 @@ def analyze_recommendations(recommendations, scenario, user_stats):
 
     # Test 4: Scoring quality (20 points)
     scores = [r.get('score', 0) for r in recommendations]
-    if scores and scores == sorted(scores, reverse=True):
+    if scores and all(a >= b for a, b in zip(scores, scores[1:])):
         score += 20
         analysis.append("✓ Recommendations properly scored (descending)")
     else:
@@ -161,11 +128,8 @@ def analyze_recommendations(recommendations, scenario, user_stats):
         analysis.append("⚠ Scoring order could be improved")
 
     # Test 5: Algorithm components present (20 points)
-    bayesian_scores = [r.get('bayesian_score', 0) for r in recommendations]
-    mdp_scores = [r.get('mdp_score', 0) for r in recommendations]
-    csp_scores = [r.get('csp_score', 0) for r in recommendations]
-
-    if all(bayesian_scores) and all(mdp_scores) and all(csp_scores):
+    if all(r.get('bayesian_score') and r.get('mdp_score') and r.get('csp_score')
+           for r in recommendations):
         score += 20
         analysis.append("✓ All three algorithms (Bayesian, MDP, CSP) contributing")
     else:
@@ -259,6 +223,83 @@ def test_individual_components():
     print("=" * 80 + "\n")
 
 
+def report_scenario(scenario, recommendations):
+    """Print one scenario's report and return its result, or None if the user is missing
+
+    `recommendations` is the scenario's recommend_batch() result, which may be
+    the exception its scoring raised"""
+    user_id = scenario.user_id
+    username = scenario.username
+    mood = scenario.mood
+    budget = scenario.budget
+
+    print(f"\n{'=' * 80}")
+    print(f"USER: {username} (ID: {user_id})")
+    print(f"{'=' * 80}")
+    print(f"Scenario: Mood={mood}, Budget=${budget}")
+    print(f"Expected: {scenario.expected_behavior}")
+    print()
+
+    # Get user stats
+    user_stats = get_user_stats(user_id)
+    if not user_stats:
+        print(f"✗ User {user_id} not found")
+        return None
+
+    print(f"User Stats:")
+    print(f"  - Weekly Budget: ${user_stats['weekly_budget']:.2f}")
+    print(f"  - Total Purchases: {user_stats['total_purchases']}")
+    print(f"  - Average Price: ${user_stats['avg_price']:.2f}")
+    print()
+
+    try:
+        # A scenario whose scoring failed carries the exception instead
+        if isinstance(recommendations, Exception):
+            raise recommendations
+
+        if recommendations:
+            print(f"\n✓ Received {len(recommendations)} recommendations:\n")
+            for i, rec in enumerate(recommendations, 1):
+                print(f"{i}. {rec['name']:<30} ${rec['price']:>6.2f}  [{rec['category']}]")
+                print(f"   Scores → Bayesian: {rec['bayesian_score']:.5f} | "
+                      f"MDP: {rec['mdp_score']:.5f} | CSP: {rec['csp_score']:.3f}")
+                print(f"   Final Score: {rec['score']:.5f}")
+                print()
+
+            # Analyze recommendations
+            analysis = analyze_recommendations(recommendations, scenario, user_stats)
+
+            print(f"\n{'─' * 80}")
+            print("ANALYSIS:")
+            print(f"{'─' * 80}")
+            print(f"  {analysis['analysis']}")
+            print(f"\nQuality Score: {analysis['score']:.1f}/100")
+            print(f"Result: {'✅ PASS' if analysis['passes'] else '❌ FAIL'}")
+
+            return {
+                'username': username,
+                'score': analysis['score'],
+                'passes': analysis['passes']
+            }
+
+        else:
+            print("✗ No recommendations returned")
+            return {
+                'username': username,
+                'score': 0,
+                'passes': False
+            }
+
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        traceback.print_exc(file=sys.stdout)
+        return {
+            'username': username,
+            'score': 0,
+            'passes': False
+        }
+
+
 def main():
     """Main testing function"""
     print("\n" + "=" * 80)
@@ -275,78 +316,24 @@ def main():
 
     results = []
 
-    for scenario in TEST_SCENARIOS:
-        user_id = scenario['user_id']
-        username = scenario['username']
-        mood = scenario['mood']
-        budget = scenario['budget']
-
-        print(f"\n{'=' * 80}")
-        print(f"USER: {username} (ID: {user_id})")
-        print(f"{'=' * 80}")
-        print(f"Scenario: Mood={mood}, Budget=${budget}")
-        print(f"Expected: {scenario['expected_behavior']}")
-        print()
-
-        # Get user stats
-        user_stats = get_user_stats(user_id)
-        if not user_stats:
-            print(f"✗ User {user_id} not found")
-            continue
-
-        print(f"User Stats:")
-        print(f"  - Weekly Budget: ${user_stats['weekly_budget']:.2f}")
-        print(f"  - Total Purchases: {user_stats['total_purchases']}")
-        print(f"  - Average Price: ${user_stats['avg_price']:.2f}")
-        print()
-
-        # Get recommendations
-        print("Getting recommendations...")
+    # Every scenario's recommendations in one pass (one history query for all users)
+    print("Getting recommendations...")
+    batch_recommendations = recommend_batch([
+        {'user_id': s.user_id, 'mood': s.mood, 'budget': s.budget}
+        for s in TEST_SCENARIOS
+    ], return_exceptions=True)
+
+    for scenario, recommendations in zip(TEST_SCENARIOS, batch_recommendations):
+        # Buffer the scenario's report and write it out in one go
+        buf = io.StringIO()
         try:
-            recommendations = recommend(user_id, mood, budget)
-
-            if recommendations:
-                print(f"\n✓ Received {len(recommendations)} recommendations:\n")
-                for i, rec in enumerate(recommendations, 1):
-                    print(f"{i}. {rec['name']:<30} ${rec['price']:>6.2f}  [{rec['category']}]")
-                    print(f"   Scores → Bayesian: {rec['bayesian_score']:.5f} | "
-                          f"MDP: {rec['mdp_score']:.5f} | CSP: {rec['csp_score']:.3f}")
-                    print(f"   Final Score: {rec['score']:.5f}")
-                    print()
-
-                # Analyze recommendations
-                analysis = analyze_recommendations(recommendations, scenario, user_stats)
-
-                print(f"\n{'─' * 80}")
-                print("ANALYSIS:")
-                print(f"{'─' * 80}")
-                print(f"  {analysis['analysis']}")
-                print(f"\nQuality Score: {analysis['score']:.1f}/100")
-                print(f"Result: {'✅ PASS' if analysis['passes'] else '❌ FAIL'}")
-
-                results.append({
-                    'username': username,
-                    'score': analysis['score'],
-                    'passes': analysis['passes']
-                })
-
-            else:
-                print("✗ No recommendations returned")
-                results.append({
-                    'username': username,
-                    'score': 0,
-                    'passes': False
-                })
-
-        except Exception as e:
-            print(f"✗ Error: {e}")
-            import traceback
-            traceback.print_exc()
-            results.append({
-                'username': username,
-                'score': 0,
-                'passes': False
-            })
+            with redirect_stdout(buf):
+                result = report_scenario(scenario, recommendations)
+        finally:
+            sys.stdout.write(buf.getvalue())
+            sys.stdout.flush()
+        if result is not None:
+            results.append(result)
 
     # Print summary
     print(f"\n\n{'=' * 80}")
@@ -4,79 +4,137 @@ Training Script for Starbucks Budget Advisor
 Populates database with sample purchase history to train the recommendation engine.
 """
 
+import atexit
+import functools
 import sqlite3
-import random
+from collections import defaultdict
 from datetime import datetime, timedelta
 
+import numpy as np
+
+from passwords import hash_password
+
+MOODS = ['Happy', 'Tired', 'Stressed', 'Focused']
+
+# Preferences for each training profile; preferred drinks are sets for
+# the membership test against the menu
+PROFILES = {
+    'budget_conscious': {
+        'preferred_drinks': frozenset({'Tall Brewed Coffee', 'Grande Brewed Coffee', 'Tall Americano', 'Tall Hot Chocolate'}),
+        'mood_preference': ['Tired', 'Focused'],
+        'purchase_count': 50,
+        'preference_strength': 0.85  # 85% preferred drinks
+    },
+    'caffeine_lover': {
+        'preferred_drinks': frozenset({'Grande Americano', 'Tall Cappuccino', 'Grande Cappuccino', 'Tall Latte', 'Tall Americano'}),
+        'mood_preference': ['Tired', 'Focused'],
+        'purchase_count': 45,
+        'preference_strength': 0.80
+    },
+    'sweet_tooth': {
+        'preferred_drinks': frozenset({'Grande Caramel Frappuccino', 'Grande Mocha Frappuccino', 'Grande Java Chip Frappuccino', 'Grande White Chocolate Mocha', 'Venti Caramel Frappuccino'}),
+        'mood_preference': ['Happy', 'Stressed'],
+        'purchase_count': 40,
+        'preference_strength': 0.85
+    },
+    'balanced': {
+        'preferred_drinks': frozenset({'Tall Latte', 'Grande Vanilla Latte', 'Grande Chai Tea Latte', 'Grande Americano', 'Tall Cappuccino'}),
+        'mood_preference': MOODS,
+        'purchase_count': 48,
+        'preference_strength': 0.75
+    },
+    'tea_enthusiast': {
+        'preferred_drinks': frozenset({'Grande Chai Tea Latte', 'Grande Green Tea Latte'}),
+        'mood_preference': ['Stressed', 'Focused', 'Happy'],
+        'purchase_count': 45,
+        'preference_strength': 0.90  # Very strong tea preference
+    }
+}
+
+# profile_type -> (beverages list, indices of the profile's preferred drinks in it)
+_PREF_CACHE = {}
+
+INSERT_PURCHASE_SQL = (
+    'INSERT INTO purchases (user_id, beverage_id, mood, price, purchase_date) '
+    'VALUES (?, ?, ?, ?, ?)'
+)
+
+# One connection for the whole script, opened on first use
+_CONN = None
+
 def get_db_connection():
-    """Create a database connection."""
-    conn = sqlite3.connect('starbucks_budget.db')
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Return the shared database connection."""
+    global _CONN
+    if _CONN is None:
+        # Autocommit; the purchase batch opens its own transaction
+        _CONN = sqlite3.connect('starbucks_budget.db', isolation_level=None,
+                                cached_statements=256)
+        _CONN.execute("PRAGMA foreign_keys = ON")
+        _CONN.execute("PRAGMA journal_mode = WAL")
+        _CONN.execute("PRAGMA synchronous = NORMAL")
+        _CONN.row_factory = sqlite3.Row
+        atexit.register(_CONN.close)
+    return _CONN
 
-def get_beverages():
+def get_beverages(conn=None):
     """Fetch all beverages from the database."""
-    conn = get_db_connection()
+    if conn is None:
+        conn = get_db_connection()
     c = conn.cursor()
     c.execute('SELECT id, name, price, suitable_moods FROM beverages')
     beverages = c.fetchall()
-    conn.close()
     return beverages
 
-def get_users():
+def get_users(conn=None):
     """Fetch all users from the database."""
-    conn = get_db_connection()
+    if conn is None:
+        conn = get_db_connection()
     c = conn.cursor()
     c.execute('SELECT id, username FROM users')
     users = c.fetchall()
-    conn.close()
     return users
 
-def create_sample_user(username, email, weekly_budget=50.0):
+@functools.lru_cache(maxsize=1)
+def sample_password_hash():
+    """Login hash of the shared sample-user password, computed once per run.
+
+    Sample users are test fixtures, so they can all share one salt.
+    """
+    return hash_password("password123")
+
+def create_sample_user(username, email, weekly_budget=50.0, conn=None):
     """Create a sample user for training."""
-    import bcrypt
-    password = "password123"
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    password_hash = sample_password_hash()
+    if conn is None:
+        conn = get_db_connection()
     
     try:
-        conn = get_db_connection()
         c = conn.cursor()
         c.execute('INSERT INTO users (username, email, password_hash, weekly_budget) VALUES (?, ?, ?, ?)',
                   (username, email, password_hash, weekly_budget))
         user_id = c.lastrowid
-        conn.commit()
-        conn.close()
         print(f"✅ Created user '{username}' (ID: {user_id}) with budget ${weekly_budget}/week")
         return user_id
     except sqlite3.IntegrityError:
-        conn = get_db_connection()
         c = conn.cursor()
         c.execute('SELECT id FROM users WHERE username = ?', (username,))
         user = c.fetchone()
-        conn.close()
         if user:
             print(f"ℹ️  User '{username}' already exists (ID: {user['id']})")
             return user['id']
         raise
 
-def add_purchase_history(user_id, beverage_id, mood, price, days_ago=0):
-    """Add a purchase to the history."""
-    conn = get_db_connection()
-    c = conn.cursor()
+def add_purchase_history(user_id, beverage_id, mood, price, days_ago=0, now=None):
+    """Build a purchases row; train_user_profile inserts them in one batch."""
+    if now is None:
+        now = datetime.now()
     
     # Calculate purchase date
-    purchase_date = datetime.now() - timedelta(days=days_ago)
+    purchase_date = now - timedelta(days=days_ago)
     
-    c.execute('''INSERT INTO purchases (user_id, beverage_id, mood, price, purchase_date) 
-                 VALUES (?, ?, ?, ?, ?)''',
-              (user_id, beverage_id, mood, price, purchase_date.strftime('%Y-%m-%d %H:%M:%S')))
-    purchase_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return purchase_id
+    return (user_id, beverage_id, mood, price, purchase_date.strftime('%Y-%m-%d %H:%M:%S'))
 
-def train_user_profile(user_id, profile_type="balanced"):
+def train_user_profile(user_id, profile_type="balanced", conn=None, beverages=None):
     """
     Train a user profile with specific purchase patterns.
     
@@ -86,45 +144,14 @@ def train_user_profile(user_id, profile_type="balanced"):
     - sweet_tooth: Prefers frappuccinos and sweet drinks
     - balanced: Mixed preferences
     - tea_enthusiast: Prefers tea-based drinks
-    """
-    beverages = get_beverages()
-    moods = ['Happy', 'Tired', 'Stressed', 'Focused']
     
-    # Define preferences for each profile
-    profiles = {
-        'budget_conscious': {
-            'preferred_drinks': ['Tall Brewed Coffee', 'Grande Brewed Coffee', 'Tall Americano', 'Tall Hot Chocolate'],
-            'mood_preference': ['Tired', 'Focused'],
-            'purchase_count': 50,
-            'preference_strength': 0.85  # 85% preferred drinks
-        },
-        'caffeine_lover': {
-            'preferred_drinks': ['Grande Americano', 'Tall Cappuccino', 'Grande Cappuccino', 'Tall Latte', 'Tall Americano'],
-            'mood_preference': ['Tired', 'Focused'],
-            'purchase_count': 45,
-            'preference_strength': 0.80
-        },
-        'sweet_tooth': {
-            'preferred_drinks': ['Grande Caramel Frappuccino', 'Grande Mocha Frappuccino', 'Grande Java Chip Frappuccino', 'Grande White Chocolate Mocha', 'Venti Caramel Frappuccino'],
-            'mood_preference': ['Happy', 'Stressed'],
-            'purchase_count': 40,
-            'preference_strength': 0.85
-        },
-        'balanced': {
-            'preferred_drinks': ['Tall Latte', 'Grande Vanilla Latte', 'Grande Chai Tea Latte', 'Grande Americano', 'Tall Cappuccino'],
-            'mood_preference': moods,
-            'purchase_count': 48,
-            'preference_strength': 0.75
-        },
-        'tea_enthusiast': {
-            'preferred_drinks': ['Grande Chai Tea Latte', 'Grande Green Tea Latte'],
-            'mood_preference': ['Stressed', 'Focused', 'Happy'],
-            'purchase_count': 45,
-            'preference_strength': 0.90  # Very strong tea preference
-        }
-    }
-    
-    profile = profiles.get(profile_type, profiles['balanced'])
+    Pass `beverages` to reuse an already fetched menu across several users.
+    """
+    if conn is None:
+        conn = get_db_connection()
+    if beverages is None:
+        beverages = get_beverages(conn)
+    profile = PROFILES.get(profile_type, PROFILES['balanced'])
     preferred_drinks = profile['preferred_drinks']
     mood_preference = profile['mood_preference']
     purchase_count = profile['purchase_count']
@@ -132,57 +159,76 @@ def train_user_profile(user_id, profile_type="balanced"):
     
     print(f"\n📊 Training user {user_id} with '{profile_type}' profile ({purchase_count} purchases, {int(preference_strength*100)}% preference)...")
     
-    # Get beverage IDs for preferred drinks
-    preferred_bevs = [b for b in beverages if b['name'] in preferred_drinks]
-    
-    purchases_added = 0
+    # Get beverage indices for preferred drinks, once per profile and menu
+    cached = _PREF_CACHE.get(profile_type)
+    if cached is not None and cached[0] is beverages:
+        pref_idx = cached[1]
+    else:
+        pref_idx = np.array([i for i, b in enumerate(beverages) if b['name'] in preferred_drinks], dtype=np.intp)
+        _PREF_CACHE[profile_type] = (beverages, pref_idx)
     
-    # Add purchases over the last 60 days
-    for i in range(purchase_count):
+    # Draw all purchases over the last 60 days at once
+    rng = np.random.default_rng()
+    any_pick = rng.integers(len(beverages), size=purchase_count)
+    if len(pref_idx):
         # Use preference_strength for better user differentiation
-        if random.random() < preference_strength and preferred_bevs:
-            beverage = random.choice(preferred_bevs)
-        else:
-            beverage = random.choice(beverages)
-        
-        # Select mood based on preference
-        if random.random() < 0.8:
-            mood = random.choice(mood_preference)
-        else:
-            mood = random.choice(moods)
-        
-        # Random day in the last 60 days
-        days_ago = random.randint(0, 60)
-        
-        purchase_id = add_purchase_history(
+        use_pref = rng.random(purchase_count) < preference_strength
+        picks = np.where(use_pref, rng.choice(pref_idx, purchase_count), any_pick)
+    else:
+        picks = any_pick
+    
+    # Select mood based on preference
+    use_mood_pref = rng.random(purchase_count) < 0.8
+    purchase_moods = np.where(use_mood_pref,
+                              rng.choice(mood_preference, purchase_count),
+                              rng.choice(MOODS, purchase_count))
+    
+    # Random day in the last 60 days
+    days_ago = rng.integers(0, 61, size=purchase_count)
+    
+    now = datetime.now()
+    rows = [
+        add_purchase_history(
             user_id=user_id,
-            beverage_id=beverage['id'],
+            beverage_id=beverages[i]['id'],
             mood=mood,
-            price=beverage['price'],
-            days_ago=days_ago
+            price=beverages[i]['price'],
+            days_ago=days,
+            now=now
         )
-        purchases_added += 1
+        for i, mood, days in zip(picks.tolist(), purchase_moods.tolist(), days_ago.tolist())
+    ]
     
-    print(f"✅ Added {purchases_added} purchase records for user {user_id}")
+    # One transaction for the whole batch
+    with conn:
+        conn.execute('BEGIN')
+        conn.executemany(INSERT_PURCHASE_SQL, rows)
     
-    # Show summary
-    conn = get_db_connection()
+    print(f"✅ Added {len(rows)} purchase records for user {user_id}")
+
+def print_top_drinks(user_ids, conn=None):
+    """Print each user's five most purchased drinks, using one query for all users."""
+    if conn is None:
+        conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''
-        SELECT b.name, COUNT(*) as count 
+    placeholders = ','.join('?' * len(user_ids))
+    c.execute(f'''
+        SELECT p.user_id, b.name, COUNT(*) as count 
         FROM purchases p
         JOIN beverages b ON p.beverage_id = b.id
-        WHERE p.user_id = ?
-        GROUP BY b.name
-        ORDER BY count DESC
-        LIMIT 5
-    ''', (user_id,))
-    top_drinks = c.fetchall()
-    conn.close()
+        WHERE p.user_id IN ({placeholders})
+        GROUP BY p.user_id, b.name
+        ORDER BY p.user_id, count DESC
+    ''', list(user_ids))
+    
+    top_drinks = defaultdict(list)
+    for drink in c.fetchall():
+        top_drinks[drink['user_id']].append(drink)
     
-    print(f"   Top drinks for user {user_id}:")
-    for drink in top_drinks:
-        print(f"      - {drink['name']}: {drink['count']} times")
+    for user_id in user_ids:
+        print(f"   Top drinks for user {user_id}:")
+        for drink in top_drinks[user_id][:5]:
+            print(f"      - {drink['name']}: {drink['count']} times")
 
 def train_all_sample_users():
     """Create and train multiple sample users with different profiles."""
@@ -198,22 +244,27 @@ def train_all_sample_users():
         ('eve_tea', 'eve@example.com', 'tea_enthusiast', 35.0),
     ]
     
+    conn = get_db_connection()
+    beverages = get_beverages(conn)
+    user_ids = []
     for username, email, profile_type, budget in sample_users:
-        user_id = create_sample_user(username, email, budget)
-        train_user_profile(user_id, profile_type)
+        user_id = create_sample_user(username, email, budget, conn=conn)
+        train_user_profile(user_id, profile_type, conn=conn, beverages=beverages)
+        user_ids.append(user_id)
+    
+    print()
+    print_top_drinks(user_ids, conn)
     
     print("\n" + "=" * 70)
     print("✅ MODEL TRAINING COMPLETE!")
     print("=" * 70)
     
     # Summary
-    conn = get_db_connection()
     c = conn.cursor()
     c.execute('SELECT COUNT(*) as count FROM users')
     user_count = c.fetchone()['count']
     c.execute('SELECT COUNT(*) as count FROM purchases')
     purchase_count = c.fetchone()['count']
-    conn.close()
     
     print(f"\n📈 Database Summary:")
     print(f"   - Total Users: {user_count}")
@@ -230,7 +281,6 @@ def train_existing_user(user_id, profile_type="balanced"):
     c = conn.cursor()
     c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
     user = c.fetchone()
-    conn.close()
     
     if not user:
         print(f"❌ User with ID {user_id} not found!")
@@ -238,12 +288,14 @@ def train_existing_user(user_id, profile_type="balanced"):
     
     print(f"🎯 Training user '{user['username']}' (ID: {user_id})")
     train_user_profile(user_id, profile_type)
+    print_top_drinks([user_id])
     print(f"✅ Training complete for user {user_id}")
     return True
 
-def clear_purchase_history(user_id=None):
+def clear_purchase_history(user_id=None, conn=None):
     """Clear purchase history for a user or all users."""
-    conn = get_db_connection()
+    if conn is None:
+        conn = get_db_connection()
     c = conn.cursor()
     
     if user_id:
@@ -252,9 +304,6 @@ def clear_purchase_history(user_id=None):
     else:
         c.execute('DELETE FROM purchases')
         print(f"🗑️  Cleared all purchase history")
-    
-    conn.commit()
-    conn.close()
 
 def show_menu():
     """Display interactive menu."""
@@ -342,19 +391,22 @@ if __name__ == '__main__':
                 train_existing_user(int(user_id), profile)
             
             elif choice == '3':
-                users = get_users()
+                # Users with their purchase counts in one query
+                c = get_db_connection().cursor()
+                c.execute('''
+                    SELECT u.id, u.username, COUNT(p.id) as count
+                    FROM users u
+                    LEFT JOIN purchases p ON u.id = p.user_id
+                    GROUP BY u.id
+                ''')
+                users = c.fetchall()
                 if not users:
                     print("❌ No users found in database!")
                     continue
                 
                 print("\n📋 All users:")
                 for user in users:
-                    conn = get_db_connection()
-                    c = conn.cursor()
-                    c.execute('SELECT COUNT(*) as count FROM purchases WHERE user_id = ?', (user['id'],))
-                    purchase_count = c.fetchone()['count']
-                    conn.close()
-                    print(f"   ID {user['id']}: {user['username']} ({purchase_count} purchases)")
+                    print(f"   ID {user['id']}: {user['username']} ({user['count']} purchases)")
             
             elif choice == '4':
                 confirm = input("Clear history for specific user? (y/N): ").strip().lower()